@@ -1,15 +1,18 @@
-import asyncio, datetime, json, logging, os, shutil, tempfile, time, typing, random
+import asyncio, audioop, contextlib, datetime, hashlib, io, json, logging, os, re, shlex, shutil, tempfile, threading, time, typing, random
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
 from pathlib import Path
+from urllib.parse import urlparse, parse_qs
 from dotenv import load_dotenv
 from datetime import datetime, timedelta
 
 import discord
-from discord.ext import commands, tasks
+from discord.ext import commands
 import edge_tts
 import yt_dlp
-import spotipy
-from spotipy.oauth2 import SpotifyClientCredentials
 from discord import app_commands
+from discord.oggparse import OggStream
 import aiohttp
 
 # -------------------------------------------------
@@ -20,26 +23,49 @@ load_dotenv()  # Load environment variables early
 CFG = {
     "PREFIX": "!",
     "FFMPEG_PATH": "ffmpeg" if shutil.which("ffmpeg") else str(Path(__file__).parent / "ffmpeg.exe"),  # Auto-detect
-    "TEMP_FOLDER": "temp_tts",
-    "MAX_TEXT": 300,
-    "QUEUE_LIMIT": 100,
-    "DEF_VOL": 1.15,  # Slight boost for music
+    "TEMP_FOLDER": "temp_tts",      # TTS spool when RAM spooling is off or unavailable
+    "TTS_SPOOL_MB": 32,             # Scratch space for renders in flight; past it a render plays but isn't cached
+    "TTS_SPOOL_RAM": True,          # Spool in /dev/shm when the platform has it
+    "TTS_CACHE_FOLDER": "tts_cache",
+    "TTS_CACHE_MB": 200,            # Disk budget for cached TTS renders, least recently used evicted first
+    "TTS_MAX_CONCURRENT": 4,        # edge-tts syntheses in flight across all guilds
+    "TTS_MAX_PER_GUILD": 1,         # ... and per guild
+    "TTS_MAX_PENDING": 16,          # Syntheses allowed to wait for a slot before new ones are turned away
+    "TTS_GUILD_PENDING": 3,         # ... of which one guild may hold
+    "MAX_TEXT": 1500,
+    "TTS_PIECE": 250,               # Longer lines are split on sentences into pieces of at most this many characters
+    "QUEUE_LIMIT": 500,  # Spotify playlists page in as the queue drains below this
+    "DEF_VOL": 1.0,   # Unity gain lets YouTube's Opus pass straight through (see OPUS_PASSTHROUGH)
     "TTS_VOL": 1.5,   # Higher boost for TTS clarity
+    "RESOLVE_CACHE_SIZE": 256,      # Max resolved tracks kept in memory
+    "RESOLVE_CACHE_TTL": 4 * 3600,  # googlevideo URLs live ~6h, drop entries well before
+    "PREFETCH_AHEAD": 2,            # Queued tracks resolved in the background while one plays
+    "EXTRACT_WORKERS": 2,           # Concurrent yt-dlp extractions across all guilds
+    "SPOTIFY_MATCH_LIMIT": 50000,   # Spotify -> YouTube matches kept on disk
+    "OPUS_PASSTHROUGH": True,       # Remux Opus streams without decoding when no volume change is active
+    "GAPLESS_PREROLL": 8,           # Seconds before a track ends that the next one is opened
+    "GAPLESS_BUFFER": 3,            # Seconds of the next track read ahead before the switch
+    "CROSSFADE_SECONDS": 0,         # >0 blends tracks (forces the PCM path, no Opus passthrough)
+    "AUDIO_CACHE_MB": 2048,         # Disk budget for cached tracks (0 disables the cache)
+    "AUDIO_CACHE_PLAY_WEIGHT": 6*3600,  # Each play counts as this many seconds of recency when evicting
+    "AUDIO_CACHE_MAX_TRACK": 15*60, # Longer tracks (mixes, streams) are never cached
+    "STREAM_RECOVER_ATTEMPTS": 3,   # Re-resolves per track when a stream dies before its end
+    "STREAM_RECOVER_TIMEOUT": 20,   # Seconds of silence to wait for a recovered stream before moving on
+    "HISTORY_SIZE": 200,            # Plays kept in memory per guild for !replay
+    "HISTORY_SPILL": True,          # Append older plays to music/history/<guild>.jsonl instead of forgetting them
+    "HISTORY_SPILL_KB": 512,        # Spill file size at which it rotates; one older file is kept, then dropped
+    "PLAY_RETRIES": 2,              # Extra attempts to open a track before it is dropped
+    "BREAKER_FAILURES": 5,          # Dropped tracks in a row that pause playback starts
+    "BREAKER_COOLDOWN": 60,         # Seconds playback starts stay paused once the breaker opens
+    "VOICE_CONNECT_TIMEOUT": 20,    # Seconds one voice connect attempt may take to finish its handshake
+    "VOICE_CONNECT_RETRIES": 3,     # Connect attempts before giving up
+    "IDLE_PARK_SECONDS": 300,       # Leave a voice channel nobody is in after this long; rejoin when someone returns
+    "TTS_QUEUE_LIMIT": 10,          # Lines (TTS and sound effects) waiting to be spoken per guild
+    "TTS_COALESCE_SECONDS": 3,      # A repeat of the line just started within this window is dropped
+    "TTS_DUCK": 0.25,               # Music gain while a line is mixed over it (None holds the music instead)
+    "TTS_DUCK_RAMP": 0.25,          # Seconds the music takes to fade down and back up around a line
 }
 
-# Initialize Spotify client
-try:
-    spotify_client = spotipy.Spotify(auth_manager=SpotifyClientCredentials(
-        client_id=os.getenv("SPOTIFY_CLIENT_ID"),
-        client_secret=os.getenv("SPOTIFY_CLIENT_SECRET")
-    ))
-    log = logging.getLogger("DS-Bot")
-    log.info("Spotify client initialized successfully")
-except Exception as e:
-    spotify_client = None
-    log = logging.getLogger("DS-Bot")
-    log.warning(f"Spotify client failed to initialize: {e}")
-
 # Voice mapping - Enhanced with rate control for better character authenticity
 DS_VOICES = {
     "tanji": {"voice": "en-US-BrandonNeural", "pitch": "+4Hz", "rate": "+6%"},
@@ -79,12 +105,29 @@ intents.members = True
 
 bot = commands.Bot(command_prefix=CFG["PREFIX"], intents=intents, help_command=None)
 
-# Music queue system - one queue per guild
+# Music queue system - one MusicQueue per guild
 music_queues = {}
+# Background look-ahead resolution of upcoming tracks
+prefetch_tasks = {}  # guild_id: asyncio.Task
+# Background paging of large Spotify playlists/albums into the queue
+spotify_expanders = {}  # guild_id: asyncio.Task of the newest link; each waits for the one before it
+# Per-guild music volume; DEF_VOL when unset
+guild_volumes = {}  # guild_id: float
+# Recent voice connect/move latencies, logged so the real numbers are visible
+voice_connect_stats = {}  # guild_id: deque of seconds
+# One playback task per guild; the only thing that starts music
+guild_players = {}  # guild_id: GuildPlayer
+# Voice clients disconnected because their channel emptied out, and the timers that do it
+parked_guilds = {}  # guild_id: channel_id to rejoin
+idle_timers = {}  # guild_id: asyncio.Task
+# Next track opened and buffered ahead of the switch
+preloads = {}  # guild_id: asyncio.Task -> (source, QueueEntry) or None
+# TTS lines and sound effects waiting their turn to be spoken
+tts_queues = {}  # guild_id: TTSQueue
 # Per-guild playback numbering and history
 play_indices = {}
 current_track = {}
-played_history = {}
+played_history = {}  # guild_id: PlayHistory
 # Slash command sync flag
 tree_synced = False
 
@@ -102,6 +145,11 @@ PANEL_UPDATE_COOLDOWN = 2.0  # seconds
 # Persistent storage file
 CHANNEL_SETTINGS_FILE = Path("music/channel_settings.json")
 USER_SONGS_FILE = Path("music/user_songs.json")
+SPOTIFY_MATCHES_FILE = Path("music/spotify_matches.json")
+SPOTIFY_TOKEN_FILE = Path("music/spotify_token.json")
+CLIP_BANK_FILE = Path("music/clips.bin")
+AUDIO_CACHE_DIR = Path("music/audio_cache")
+HISTORY_DIR = Path("music/history")
 
 def load_channel_settings():
     """Load channel settings from JSON file"""
@@ -317,11 +365,6 @@ class ReplayModal(discord.ui.Modal, title="Replay Song"):
                     await interaction.followup.send("❌ Invalid song number", ephemeral=True)
                     return
             
-            # Stop current playback
-            if vc.is_playing() or vc.is_paused():
-                vc.stop()
-                await asyncio.sleep(0.3)
-            
             # Get the track to replay
             if number is None:
                 # Replay current
@@ -329,23 +372,15 @@ class ReplayModal(discord.ui.Modal, title="Replay Song"):
                 if not info:
                     await interaction.followup.send('❌ No track to replay', ephemeral=True)
                     return
-                query = info['url']
-                idx = info['index']
             else:
                 # Replay by number
-                history = played_history.get(guild_id, [])
-                match = next((t for t in history if t['index'] == number), None)
-                if not match:
+                info = await get_history(guild_id).lookup(number)
+                if not info:
                     await interaction.followup.send(f'❌ No track numbered #{number} found', ephemeral=True)
                     return
-                query = match['url']
-                idx = number
             
-            # Play the track
-            player = await YTDLSource.from_url(query, loop=bot.loop, stream=True)
-            vc.play(player, after=lambda e: bot.loop.create_task(play_next(interaction.guild)) if not e else log.error(f"Player error: {e}"))
-            
-            await interaction.followup.send(f"🔁 Replaying [#{idx}]: **{player.title}**", ephemeral=True)
+            await replay_track(interaction.guild, vc, info)
+            await interaction.followup.send(f"🔁 Replaying [#{info['index']}]: **{info['title']}**", ephemeral=True)
         except Exception as e:
             log.error(f"Replay error: {e}")
             try:
@@ -458,8 +493,7 @@ class MusicControlPanel(discord.ui.View):
             
             elif custom_id == "music_stop":
                 if vc:
-                    if guild_id in music_queues:
-                        music_queues[guild_id].clear()
+                    reset_music(guild_id)
                     vc.stop()
                     await interaction.response.send_message("⏹️ Stopped & cleared queue", ephemeral=True, delete_after=3)
                 else:
@@ -467,8 +501,7 @@ class MusicControlPanel(discord.ui.View):
             
             elif custom_id == "music_leave":
                 if vc:
-                    if guild_id in music_queues:
-                        music_queues[guild_id].clear()
+                    reset_music(guild_id)
                     await vc.disconnect()
                     await interaction.response.send_message("🚪 Left voice channel", ephemeral=True, delete_after=3)
                 else:
@@ -486,24 +519,23 @@ class MusicControlPanel(discord.ui.View):
             
             elif custom_id == "music_shuffle":
                 if guild_id in music_queues and len(music_queues[guild_id]) > 0:
-                    import random
-                    random.shuffle(music_queues[guild_id])
+                    music_queues[guild_id].shuffle()
+                    cancel_prefetch(guild_id)
+                    schedule_prefetch(guild_id)
                     await interaction.response.send_message("🔀 Queue shuffled", ephemeral=True, delete_after=3)
                 else:
                     await interaction.response.send_message("❌ Queue is empty", ephemeral=True, delete_after=3)
             
             elif custom_id == "music_volume_up":
-                if vc and hasattr(vc.source, 'volume'):
-                    new_vol = min(2.0, vc.source.volume + 0.1)
-                    vc.source.volume = new_vol
+                new_vol = min(2.0, guild_volumes.get(guild_id, CFG["DEF_VOL"]) + 0.1)
+                if vc and set_music_volume(interaction.guild, new_vol):
                     await interaction.response.send_message(f"🔊 Volume: {int(new_vol * 100)}%", ephemeral=True, delete_after=3)
                 else:
                     await interaction.response.send_message("❌ No audio playing", ephemeral=True, delete_after=3)
             
             elif custom_id == "music_volume_down":
-                if vc and hasattr(vc.source, 'volume'):
-                    new_vol = max(0.1, vc.source.volume - 0.1)
-                    vc.source.volume = new_vol
+                new_vol = max(0.1, guild_volumes.get(guild_id, CFG["DEF_VOL"]) - 0.1)
+                if vc and set_music_volume(interaction.guild, new_vol):
                     await interaction.response.send_message(f"🔉 Volume: {int(new_vol * 100)}%", ephemeral=True, delete_after=3)
                 else:
                     await interaction.response.send_message("❌ No audio playing", ephemeral=True, delete_after=3)
@@ -512,9 +544,9 @@ class MusicControlPanel(discord.ui.View):
                 if guild_id not in music_queues or len(music_queues[guild_id]) == 0:
                     await interaction.response.send_message("🎵 Queue is empty", ephemeral=True, delete_after=5)
                 else:
-                    queue_list = music_queues[guild_id][:10]
+                    queue_list = music_queues[guild_id].peek(10)
                     total = len(music_queues[guild_id])
-                    queue_text = "\n".join([f"`{i+1}.` {song[:50]}" for i, song in enumerate(queue_list)])
+                    queue_text = "\n".join([f"`{i+1}.` {entry.display[:50]}" for i, entry in enumerate(queue_list)])
                     if total > 10:
                         queue_text += f"\n\n... and {total - 10} more tracks"
                     
@@ -662,52 +694,530 @@ async def update_control_panel(guild, track_info, is_paused=False):
 # -------------------------------------------------
 # 3.  TTS ENGINE (IMPROVED)
 # -------------------------------------------------
+SENTENCE_END = re.compile(r'(?<=[.!?…。！？।])\s+')
+
+class TTSStream:
+    """Blocking file-like buffer between edge-tts (event loop) and FFmpeg's stdin writer thread"""
+    def __init__(self):
+        self._chunks = deque()
+        self._closed = False
+        self._cond = threading.Condition()
+
+    def feed(self, data: bytes):
+        with self._cond:
+            self._chunks.append(data)
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def read(self, n: int = -1) -> bytes:
+        with self._cond:
+            while not self._chunks and not self._closed:
+                self._cond.wait()
+            if not self._chunks:
+                return b''
+            data = self._chunks.popleft()
+            if 0 < n < len(data):
+                self._chunks.appendleft(data[n:])
+                data = data[:n]
+            return data
+
+class TTSAudio(discord.FFmpegPCMAudio):
+    """TTS playback that records time-to-first-audio when its first frame is read"""
+    def __init__(self, source, *, requested: float = None, kind: str, **kwargs):
+        super().__init__(source, **kwargs)
+        self._stream = source if isinstance(source, TTSStream) else None
+        self.requested = requested
+        self.kind = kind
+        self._first = requested is not None  # Later pieces of a long line aren't first audio
+
+    def read(self) -> bytes:
+        ret = super().read()
+        if ret and self._first:
+            self._first = False
+            tts.record_first_audio(time.monotonic() - self.requested, self.kind)
+        return ret
+
+    def cleanup(self):
+        super().cleanup()
+        # Wakes FFmpeg's stdin writer, and lets go of a spool file this line was following
+        if self._stream:
+            self._stream.close()
+
+class TTSLine(discord.AudioSource):
+    """A long line spoken as consecutive pieces, each rendered while the one before it plays
+
+    Renders arrive from the event loop through `add()`; reading waits for the next one the
+    same way a streamed render makes FFmpeg wait for edge-tts. Over music that wait happens on
+    a VoiceBuffer's thread, so the music plays on (back at full level) while it lasts.
+    """
+    PIECE_TIMEOUT = 15  # Seconds to wait for a piece before cutting the line short
+
+    def __init__(self, open_piece):
+        self._open = open_piece  # (render, first) -> AudioSource
+        self._pieces = deque()
+        self._done = False
+        self._cond = threading.Condition()
+        self._current = None
+        self._first = True
+        self.closed = False
+
+    def add(self, audio):
+        with self._cond:
+            self._pieces.append(audio)
+            self._cond.notify()
+
+    def finish(self):
+        with self._cond:
+            self._done = True
+            self._cond.notify_all()
+
+    def _next_piece(self):
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._pieces or self._done, self.PIECE_TIMEOUT):
+                log.error("TTS piece did not arrive in time; cutting the line short")
+                return None
+            return self._pieces.popleft() if self._pieces else None
+
+    def is_opus(self) -> bool:
+        return False
+
+    def read(self) -> bytes:
+        while not self.closed:
+            if self._current is None:
+                audio = self._next_piece()
+                if audio is None:
+                    return b''
+                self._current = self._open(audio, self._first)
+                self._first = False
+            ret = self._current.read()
+            if ret:
+                return ret
+            self._current.cleanup()
+            self._current = None
+        return b''
+
+    def cleanup(self):
+        self.closed = True
+        self.finish()
+        if self._current:
+            self._current.cleanup()
+            self._current = None
+
+class TTSSpool:
+    """Registry of TTS scratch files, each deleted the moment its last reference is released
+
+    A render in flight is written here rather than held in memory. The render holds one
+    reference, and every listener following it through a SpoolReader holds another, so the
+    file outlives the render only as long as someone is still reading it. All files count
+    against a hard byte budget; whatever a previous run left behind is removed at startup.
+    In /dev/shm the writes never touch the persistent disk.
+    """
+    SUFFIX = ".spool"
+
+    def __init__(self, directory: Path, max_bytes: int):
+        self.dir = directory
+        self.max_bytes = max_bytes
+        self.total = 0
+        self._files = {}  # Path: [open file or None once finished, bytes, references]
+        self._cond = threading.Condition()  # Guards the registry; readers wait on it for writes
+        try:
+            self.dir.mkdir(parents=True, exist_ok=True)
+            for fp in self.dir.glob(f"*{self.SUFFIX}"):
+                fp.unlink(missing_ok=True)
+        except Exception as e:
+            log.error(f"Failed to prepare TTS spool {self.dir}: {e}")
+
+    def path(self, name: str) -> Path:
+        return self.dir / f"{name}{self.SUFFIX}"
+
+    def create(self, name: str):
+        """A new, empty spool file holding one reference, or None if it can't be made"""
+        path = self.path(name)
+        with self._cond:
+            if path in self._files:
+                return None
+            try:
+                self._files[path] = [open(path, "wb"), 0, 1]
+            except OSError as e:
+                log.error(f"Failed to create TTS spool file: {e}")
+                return None
+        return path
+
+    def write(self, path: Path, data: bytes) -> bool:
+        """Append to a spool file; False (and the file finished early) when over budget or on error
+
+        A file other listeners are following is always completed, budget or not.
+        """
+        with self._cond:
+            entry = self._files[path]
+            if self.total + len(data) > self.max_bytes and entry[2] == 1:
+                log.warning(f"TTS spool full ({self.total / 2**20:.1f} MB); this render won't be cached")
+                self._finish(entry)
+                return False
+            try:
+                entry[0].write(data)
+                entry[0].flush()  # Readers follow the file through their own handles
+            except OSError as e:
+                log.error(f"Failed to write TTS spool file: {e}")
+                self._finish(entry)
+                return False
+            entry[1] += len(data)
+            self.total += len(data)
+            self._cond.notify_all()
+            return True
+
+    def finish(self, path: Path):
+        """No more data is coming; readers get EOF once they catch up"""
+        with self._cond:
+            self._finish(self._files[path])
+
+    def _finish(self, entry):
+        if entry[0]:
+            entry[0].close()
+            entry[0] = None
+        self._cond.notify_all()
+
+    def wait(self, path: Path, offset: int):
+        """Block until the file holds more than `offset` bytes or is finished (caller holds a reference)"""
+        with self._cond:
+            entry = self._files[path]
+            while entry[1] <= offset and entry[0]:
+                self._cond.wait()
+
+    def acquire(self, path: Path) -> bool:
+        """Take a reference on a spool file; False if it is already gone"""
+        with self._cond:
+            entry = self._files.get(path)
+            if entry is None:
+                return False
+            entry[2] += 1
+            return True
+
+    def release(self, path: Path):
+        with self._cond:
+            entry = self._files.get(path)
+            if entry is None:
+                return
+            entry[2] -= 1
+            if entry[2] > 0:
+                return
+            del self._files[path]
+            self.total -= entry[1]
+            self._finish(entry)
+        path.unlink(missing_ok=True)
+
+    def copy(self, path: Path, dest: Path) -> int:
+        """Put a finished spool file's contents at `dest`; returns its size"""
+        try:
+            os.link(path, dest)  # Same filesystem: no copy at all
+        except OSError:
+            shutil.copyfile(path, dest)
+        return self._files[path][1]
+
+class SpoolReader(TTSStream):
+    """A listener joined to a render in flight, following its spool file as edge-tts writes it
+
+    Holds a spool reference (taken by the caller) until it is closed or dropped unplayed.
+    """
+    def __init__(self, spool: TTSSpool, path: Path):
+        super().__init__()
+        self._spool = spool
+        self._path = path
+        self._file = None
+        self._held = True
+
+    def read(self, n: int = -1) -> bytes:
+        if self._closed:
+            return b''
+        try:
+            if self._file is None:
+                self._file = open(self._path, "rb")
+            self._spool.wait(self._path, self._file.tell())
+            data = self._file.read(n if n > 0 else -1)
+        except (OSError, ValueError) as e:
+            if not self._closed:
+                log.error(f"Failed to read TTS spool: {e}")
+            data = b''
+        if not data:
+            self.close()
+        return data
+
+    def close(self):
+        super().close()
+        if self._file:
+            self._file.close()
+        if self._held:
+            self._held = False
+            self._spool.release(self._path)
+
+    def __del__(self):
+        # A queued line dropped without being played still lets go of its file
+        self.close()
+
+def spool_dir() -> Path:
+    shm = Path("/dev/shm")
+    if CFG["TTS_SPOOL_RAM"] and shm.is_dir() and os.access(shm, os.W_OK):
+        return shm / "ash_tts"
+    return Path(CFG["TEMP_FOLDER"])
+
+class TTSBusy(Exception):
+    """Too many TTS requests are already waiting; the caller should back off"""
+
 class TTSEngine:
-    def __init__(self, temp_dir: Path):
-        self.temp_dir = temp_dir
-        self.temp_dir.mkdir(exist_ok=True)
+    """edge-tts synthesis behind a content-addressed disk cache
+
+    Renders are keyed by sha1 of (voice, pitch, rate, text), so a repeated phrase plays
+    from disk with no network round-trip. Eviction is LRU, tracked by file mtime so it
+    survives restarts. A miss is streamed: edge-tts chunks go straight to FFmpeg as they
+    arrive and the finished render is written to the cache afterwards.
+
+    Syntheses are admitted per guild and then globally, so a burst can't open an
+    unbounded number of websockets; past TTS_MAX_PENDING waiters, requests get TTSBusy.
+    """
+    def __init__(self, spool: TTSSpool, cache_dir: Path, max_bytes: int):
+        self.spool = spool
+        self.cache_dir = cache_dir
+        self.cache_dir.mkdir(exist_ok=True)
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key: size in bytes, least recently used first
+        self._total = 0
+        self._inflight = {}  # key: asyncio.Task rendering it
+        self._slots = asyncio.Semaphore(CFG["TTS_MAX_CONCURRENT"])
+        self._guild_slots = {}  # guild_id: [Semaphore, requests admitted or waiting]
+        self._waiting = 0
+        self.hits = self.misses = 0
+        self.first_audio = {"cache": deque(maxlen=50), "stream": deque(maxlen=50)}  # seconds
+        self._load()
+
+    def _load(self):
+        try:
+            for part in self.cache_dir.glob("*.part"):
+                part.unlink(missing_ok=True)
+            files = [(fp.stat(), fp) for fp in self.cache_dir.glob("*.mp3")]
+            for st, fp in sorted(files, key=lambda f: f[0].st_mtime):
+                self._entries[fp.stem] = st.st_size
+                self._total += st.st_size
+            log.info(f"TTS cache: {len(self._entries)} renders, {self._total / 2**20:.1f} MB")
+        except Exception as e:
+            log.error(f"Failed to scan TTS cache: {e}")
+
+    @staticmethod
+    def cache_key(cfg: dict, text: str) -> str:
+        profile = f"{cfg['voice']}|{cfg['pitch']}|{cfg.get('rate', '0%')}|{text}"
+        return hashlib.sha1(profile.encode()).hexdigest()
+
+    @staticmethod
+    def split(text: str, size: int) -> list:
+        """Break text into pieces of at most `size` characters, on sentence boundaries where possible"""
+        pieces, piece = [], ""
+        for sentence in SENTENCE_END.split(text.strip()):
+            while len(sentence) > size:
+                # A run-on sentence is cut at the last space that fits
+                cut = sentence.rfind(" ", 0, size)
+                cut = cut if cut > 0 else size
+                if piece:
+                    pieces.append(piece)
+                    piece = ""
+                pieces.append(sentence[:cut])
+                sentence = sentence[cut:].lstrip()
+            if piece and len(piece) + 1 + len(sentence) > size:
+                pieces.append(piece)
+                piece = sentence
+            else:
+                piece = f"{piece} {sentence}" if piece else sentence
+        if piece:
+            pieces.append(piece)
+        return pieces
 
-    async def create(self, text: str, character: str) -> Path:
+    def _locate(self, text: str, character: str):
         if len(text) > CFG["MAX_TEXT"]:
             text = text[:CFG["MAX_TEXT"]] + "…"
+        cfg = DS_VOICES.get(character, DS_VOICES["girl"])
+        key = self.cache_key(cfg, text)
+        return text, cfg, key, self.cache_dir / f"{key}.mp3"
+
+    async def file(self, text: str, character: str) -> Path:
+        """Path of the cached render, synthesizing it first if needed"""
+        audio = await self.render(text, character)
+        if isinstance(audio, TTSStream):
+            # Nobody is listening to this stream; wait for it to land in the cache
+            audio.close()
+            key = self._locate(text, character)[2]
+            task = self._inflight.get(key)
+            path = await asyncio.shield(task) if task else None
+            if path is None:
+                raise Exception("TTS render was too large to cache")
+            return path
+        return audio
+
+    async def render_line(self, line: TTSLine, pieces: list, character: str, guild_id: int, previous: str):
+        """Render `pieces` into `line` in order, each once the synthesis of the one before it is done
+
+        One synthesis at a time keeps a long line inside the guild's admission limit, and
+        edge-tts outpaces playback, so each piece is ready before the line reaches it.
+        """
+        try:
+            for text in pieces:
+                task = self._inflight.get(self._locate(previous, character)[2])
+                if task is not None:
+                    # A piece that failed to cache has still been heard; carry on with the next
+                    with contextlib.suppress(Exception):
+                        await asyncio.shield(task)
+                if line.closed:
+                    return
+                line.add(await self.render(text, character, guild_id))
+                previous = text
+        except Exception as e:
+            log.error("TTS line error: %s", e)
+        finally:
+            line.finish()
 
-        ts = int(time.time() * 1000)
-        out = self.temp_dir / f"tts_{character}_{ts}.mp3"
+    async def render(self, text: str, character: str, guild_id: int = 0):
+        """The cached file for this phrase, or a TTSStream that fills as edge-tts synthesizes it"""
+        text, cfg, key, out = self._locate(text, character)
 
-        cfg = DS_VOICES.get(character, DS_VOICES["girl"])
+        if key in self._entries and out.exists():
+            self.hits += 1
+            self._entries.move_to_end(key)
+            try:
+                os.utime(out)  # LRU order survives restarts
+            except OSError:
+                pass
+            return out
 
+        task = self._inflight.get(key)
+        if task is not None:
+            # Someone is already synthesizing this phrase; follow its spool file as it is written
+            spool = self.spool.path(key)
+            if self.spool.acquire(spool):
+                return SpoolReader(self.spool, spool)
+            # Not spooled (over budget): wait for it, and synthesize again if it wasn't cached
+            with contextlib.suppress(Exception):
+                await asyncio.shield(task)
+            if key in self._entries and out.exists():
+                return out
+
+        self._admit(guild_id)
+        self.misses += 1
+        stream = TTSStream()
+        # Created up front so a listener asking for the same phrase right after can join it
+        spool = self.spool.create(key)
+        task = self._inflight[key] = asyncio.ensure_future(self._stream(text, cfg, key, out, stream, spool, guild_id))
+        task.add_done_callback(lambda t: self._finished(key, t))
+        return stream
+
+    def _finished(self, key: str, task: asyncio.Task):
+        self._inflight.pop(key, None)
+        if not task.cancelled():
+            task.exception()  # Already logged by _stream; mark it retrieved
+
+    def _admit(self, guild_id: int):
+        """Take a place in line for one synthesis, or refuse with TTSBusy when the line is full"""
+        guild = self._guild_slots.get(guild_id)
+        if self._waiting >= CFG["TTS_MAX_PENDING"] or (
+                guild and guild[1] >= CFG["TTS_MAX_PER_GUILD"] + CFG["TTS_GUILD_PENDING"]):
+            raise TTSBusy("TTS queue is full")
+        if guild is None:
+            guild = self._guild_slots[guild_id] = [asyncio.Semaphore(CFG["TTS_MAX_PER_GUILD"]), 0]
+        guild[1] += 1
+        self._waiting += 1
+
+    @contextlib.asynccontextmanager
+    async def synth_slot(self, guild_id: int):
+        """Hold an admitted synthesis' slots: the guild's cap first, then the global one"""
+        guild = self._guild_slots[guild_id]
+        waiting = True
         try:
-            communicate = edge_tts.Communicate(
-                text=text,
-                voice=cfg["voice"],
-                pitch=cfg["pitch"],
-                rate=cfg.get("rate", "0%")  # Support rate parameter
-            )
-            await communicate.save(str(out))
-            
-            # Verify file was created and has content
-            if not out.exists() or out.stat().st_size < 10:
-                raise Exception("TTS file creation failed")
-                
+            async with guild[0], self._slots:
+                self._waiting -= 1
+                waiting = False
+                yield
+        finally:
+            if waiting:
+                self._waiting -= 1
+            guild[1] -= 1
+            if not guild[1]:
+                self._guild_slots.pop(guild_id, None)
+
+    async def _stream(self, text: str, cfg: dict, key: str, out: Path, stream: TTSStream, spool, guild_id: int):
+        """Synthesize into `stream` and `spool`; the cached path, or None if it was too large to spool"""
+        size = 0
+        try:
+            # edge-tts opens and closes its own aiohttp session (and any connector passed in)
+            # per call, so connections can't be pooled; capping concurrency is what's left
+            async with self.synth_slot(guild_id):
+                communicate = edge_tts.Communicate(
+                    text=text,
+                    voice=cfg["voice"],
+                    pitch=cfg["pitch"],
+                    rate=cfg.get("rate", "0%")  # Support rate parameter
+                )
+                async for chunk in communicate.stream():
+                    if chunk["type"] == "audio":
+                        size += len(chunk["data"])
+                        stream.feed(chunk["data"])
+                        if spool and not self.spool.write(spool, chunk["data"]):
+                            # Over budget with nobody else following it: stop spooling, free it now
+                            self.spool.release(spool)
+                            spool = None
+            if size < 10:
+                raise Exception("TTS stream returned no audio")
+            if not spool:
+                # Its listener heard it all; it just can't be cached
+                return None
+            self.spool.finish(spool)
+            self._store(key, out, spool)
             return out
         except Exception as e:
             log.error("TTS creation error: %s", e)
             raise
+        finally:
+            stream.close()
+            if spool:
+                # Readers still following the file keep it until they are done
+                self.spool.finish(spool)
+                self.spool.release(spool)
+
+    def _store(self, key: str, out: Path, spool: Path):
+        part = out.with_suffix(".part")
+        try:
+            size = self.spool.copy(spool, part)
+            part.replace(out)
+        except Exception:
+            part.unlink(missing_ok=True)
+            raise
+        self._entries[key] = size
+        self._total += size
+        self._evict()
+
+    def record_first_audio(self, seconds: float, kind: str):
+        """Called from the audio thread when a TTS clip's first frame goes out"""
+        samples = self.first_audio[kind]
+        samples.append(seconds)
+        ordered = sorted(samples)
+        log.info(
+            f"TTS first audio in {seconds * 1000:.0f} ms ({kind}; median {ordered[len(ordered) // 2] * 1000:.0f} ms "
+            f"over {len(ordered)})"
+        )
 
-    async def cleanup_old(self, older_than: int = 2700):  # 45 minutes
-        now = time.time()
-        for fp in self.temp_dir.glob("*.mp3"):
-            if now - fp.stat().st_mtime > older_than:
-                try:
-                    fp.unlink()
-                except:
-                    pass
+    def _evict(self):
+        # The newest render always stays, even if it alone is over budget
+        while self._total > self.max_bytes and len(self._entries) > 1:
+            key, size = self._entries.popitem(last=False)
+            self._total -= size
+            # A clip still playing keeps its open handle; unlink is safe
+            (self.cache_dir / f"{key}.mp3").unlink(missing_ok=True)
 
 # -------------------------------------------------
 # 4.  MUSIC SYSTEM - IMPROVED FFMPEG CONFIG
 # -------------------------------------------------
 ytdl_options = {
-    'format': 'bestaudio[ext=m4a]/bestaudio[ext=webm]/bestaudio/best',
+    # Opus first (itag 251) so it can be passed to Discord without a decode/re-encode
+    'format': 'bestaudio[acodec=opus]/bestaudio[ext=m4a]/bestaudio[ext=webm]/bestaudio/best',
     'extractaudio': True,
     'audioformat': 'opus',
     'audioquality': 0,  # Best quality (0-9, 0 is best)
@@ -735,46 +1245,708 @@ ffmpeg_options = {
     'options': '-vn -b:a 320k -ar 48000 -ac 2 -filter:a "volume=1.0"'  # 320kbps, 48kHz, stereo, full volume
 }
 
-class YTDLSource(discord.PCMVolumeTransformer):
-    def __init__(self, source, *, data, volume=1.15):
-        super().__init__(source, volume)
+# Fields kept from a yt-dlp info dict - the full dict carries every format and is ~100KB
+CACHED_INFO_FIELDS = (
+    'id', 'title', 'url', 'duration', 'thumbnail', 'webpage_url',
+    'extractor', 'ext', 'acodec', 'abr', 'format_id', 'http_headers',
+)
+YOUTUBE_ID_RE = re.compile(r'(?:[?&]v=|youtu\.be/|/shorts/|/embed/)([\w-]{11})')
+
+class ResolveCache:
+    """LRU cache of resolved tracks so repeat plays skip yt-dlp extraction"""
+    def __init__(self, max_entries: int, ttl: int):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # video key: (expires_at, data)
+        self._aliases = OrderedDict()  # normalized query: video key
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        """Map a query or YouTube URL to a stable cache key"""
+        query = query.strip()
+        match = YOUTUBE_ID_RE.search(query)
+        if match:
+            return f"yt:{match.group(1)}"
+        return " ".join(query.lower().split())
+
+    def _expiry(self, data: dict) -> float:
+        """Expire before the signed stream URL does"""
+        expires_at = time.time() + self.ttl
+        try:
+            expire = parse_qs(urlparse(data.get('url', '')).query).get('expire')
+            if expire:
+                expires_at = min(expires_at, int(expire[0]) - 600)
+        except ValueError:
+            pass
+        return expires_at
+
+    def get(self, query: str):
+        key = self.normalize(query)
+        key = self._aliases.get(key, key)
+        entry = self._entries.get(key)
+        if entry and entry[0] > time.time():
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+        if entry:
+            del self._entries[key]
+        self.misses += 1
+        return None
+
+    def contains(self, query: str) -> bool:
+        """Check for a fresh entry without touching LRU order or stats"""
+        key = self.normalize(query)
+        entry = self._entries.get(self._aliases.get(key, key))
+        return bool(entry and entry[0] > time.time())
+
+    def put(self, query: str, data: dict) -> dict:
+        data = {k: data[k] for k in CACHED_INFO_FIELDS if k in data}
+        key = f"yt:{data['id']}" if data.get('id') else self.normalize(query)
+        self._entries[key] = (self._expiry(data), data)
+        self._entries.move_to_end(key)
+        alias = self.normalize(query)
+        if alias != key:
+            self._aliases[alias] = key
+            self._aliases.move_to_end(alias)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        while len(self._aliases) > self.max_entries * 4:
+            self._aliases.popitem(last=False)
+        return data
+
+    def invalidate(self, query: str):
+        key = self.normalize(query)
+        self._entries.pop(self._aliases.pop(key, key), None)
+
+resolve_cache = ResolveCache(CFG["RESOLVE_CACHE_SIZE"], CFG["RESOLVE_CACHE_TTL"])
+
+# Extraction lanes, highest priority first
+LANE_INTERACTIVE = 0  # A user is waiting on this track right now
+LANE_PREFETCH = 1     # The next track in a guild's queue
+LANE_BULK = 2         # Further look-ahead, playlist expansion
+
+class ExtractionScheduler:
+    """Bounded yt-dlp worker pool with priority lanes and per-guild round robin
+
+    Each worker owns one long-lived YoutubeDL instance, built and warmed when the
+    worker starts, so jobs never pay for extractor setup.
+    """
+    def __init__(self, workers: int):
+        self.workers = workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ytdl")
+        # One OrderedDict per lane: guild_id -> deque of (fn, future), rotated after each job
+        self._lanes = [OrderedDict() for _ in (LANE_INTERACTIVE, LANE_PREFETCH, LANE_BULK)]
+        self._wakeup = None
+        self._tasks = []
+        self.warm_times = []   # Seconds each worker spent building and warming its YoutubeDL
+        self.setup_times = []  # Steady-state cost of a fresh YoutubeDL, i.e. what each job used to pay
+        self.jobs_run = 0
+
+    def start(self):
+        """Spawn the workers; each warms its YoutubeDL instance straight away"""
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Event()
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def stats(self) -> dict:
+        setup = sum(self.setup_times) / len(self.setup_times) if self.setup_times else 0.0
+        return {
+            "workers": len(self.setup_times),
+            "setup_ms": setup * 1000,
+            "jobs": self.jobs_run,
+            "saved_s": setup * self.jobs_run,
+            "pending": self.pending(),
+        }
+
+    def submit(self, fn, *, guild_id=0, lane=LANE_INTERACTIVE) -> asyncio.Future:
+        """Queue fn(ydl) to run on a worker; the returned future resolves with its result"""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self._lanes[lane].setdefault(guild_id, deque()).append((fn, future))
+        self._wakeup.set()
+        return future
+
+    def promote(self, future, lane):
+        """Move a queued job to a higher-priority lane, e.g. when a user starts waiting on a prefetch"""
+        for current, guilds in enumerate(self._lanes):
+            if current <= lane:
+                continue
+            for guild_id, jobs in guilds.items():
+                for job in jobs:
+                    if job[1] is future:
+                        jobs.remove(job)
+                        if not jobs:
+                            del guilds[guild_id]
+                        self._lanes[lane].setdefault(guild_id, deque()).append(job)
+                        return
+
+    def cancel_pending(self, guild_id, lane):
+        """Drop a guild's queued (not yet running) jobs in one lane"""
+        for _, future in self._lanes[lane].pop(guild_id, ()):
+            future.cancel()
+
+    def pending(self) -> int:
+        return sum(len(jobs) for guilds in self._lanes for jobs in guilds.values())
+
+    def _next_job(self):
+        for guilds in self._lanes:
+            while guilds:
+                guild_id, jobs = next(iter(guilds.items()))
+                job = jobs.popleft()
+                if jobs:
+                    guilds.move_to_end(guild_id)  # Let the other guilds go first
+                else:
+                    del guilds[guild_id]
+                if not job[1].cancelled():
+                    return job
+        return None
+
+    def _build_ydl(self):
+        start = time.perf_counter()
+        ydl = yt_dlp.YoutubeDL(ytdl_options)
+        # Instantiating the extractors we actually hit loads and compiles them up front
+        for ie_key in ("Youtube", "YoutubeSearch", "Generic"):
+            ydl.get_info_extractor(ie_key)
+        warm = time.perf_counter() - start
+        # Time one throwaway instance after warm-up: the per-request cost the pool avoids
+        start = time.perf_counter()
+        yt_dlp.YoutubeDL(ytdl_options).close()
+        return ydl, warm, time.perf_counter() - start
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        ydl, warm, setup = await loop.run_in_executor(self._executor, self._build_ydl)
+        self.warm_times.append(warm)
+        self.setup_times.append(setup)
+        log.info(f"yt-dlp worker ready ({warm * 1000:.0f}ms warm-up, {setup * 1000:.0f}ms per-request setup avoided)")
+        while True:
+            job = self._next_job()
+            if job is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            fn, future = job
+            try:
+                result = await loop.run_in_executor(self._executor, fn, ydl)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            self.jobs_run += 1
+            if self.jobs_run % 50 == 0:
+                stats = self.stats()
+                log.info(f"yt-dlp pool: {stats['jobs']} extractions, ~{stats['saved_s']:.1f}s of setup saved")
+
+extractor = ExtractionScheduler(CFG["EXTRACT_WORKERS"])
+# Extractions in progress, so a prefetch and a play of the same query share one yt-dlp run
+inflight_resolves = {}  # cache key: (asyncio.Task, scheduler future holder)
+
+class SpotifyMatchIndex:
+    """Persistent Spotify track id / ISRC -> YouTube video id map, so repeat plays skip the search"""
+    def __init__(self, path: Path, limit: int):
+        self.path = path
+        self.limit = limit
+        self._tracks = OrderedDict()  # spotify track id: video id
+        self._isrcs = OrderedDict()   # ISRC: video id
+        self._save_handle = None
+        self.load()
+
+    def load(self):
+        try:
+            if self.path.exists():
+                with open(self.path, 'r') as f:
+                    data = json.load(f)
+                self._tracks = OrderedDict(data.get('tracks', {}))
+                self._isrcs = OrderedDict(data.get('isrc', {}))
+                log.info(f"Loaded {len(self._tracks)} Spotify matches")
+        except Exception as e:
+            log.error(f"Failed to load Spotify matches: {e}")
+
+    def save(self):
+        self._save_handle = None
+        try:
+            self.path.parent.mkdir(exist_ok=True)
+            tmp = self.path.with_suffix('.tmp')
+            with open(tmp, 'w') as f:
+                json.dump({'tracks': self._tracks, 'isrc': self._isrcs}, f)
+            tmp.replace(self.path)
+        except Exception as e:
+            log.error(f"Failed to save Spotify matches: {e}")
+
+    def lookup(self, spotify_id=None, isrc=None):
+        return self._tracks.get(spotify_id) or self._isrcs.get(isrc)
+
+    def record(self, video_id, spotify_id=None, isrc=None):
+        for table, key in ((self._tracks, spotify_id), (self._isrcs, isrc)):
+            if key:
+                table[key] = video_id
+                table.move_to_end(key)
+                while len(table) > self.limit:
+                    table.popitem(last=False)
+        # Playlists resolve in bursts; write once the burst settles
+        if self._save_handle is None:
+            self._save_handle = asyncio.get_running_loop().call_later(30, self.save)
+
+    def forget(self, spotify_id=None, isrc=None):
+        self._tracks.pop(spotify_id, None)
+        self._isrcs.pop(isrc, None)
+
+spotify_matches = SpotifyMatchIndex(SPOTIFY_MATCHES_FILE, CFG["SPOTIFY_MATCH_LIMIT"])
+
+class AudioCache:
+    """Size-capped disk cache of played tracks as Ogg Opus, keyed by YouTube video id
+
+    Passthrough streams are teed to a .part file while they play and kept once they end
+    cleanly. Eviction ranks by last play plus a bonus per play, so songs the server keeps
+    coming back to outlive one-off requests.
+    """
+    def __init__(self, directory: Path, max_bytes: int):
+        self.dir = directory
+        self.max_bytes = max_bytes
+        self.index_path = directory / "index.json"
+        self._entries = {}    # video id: {"size", "plays", "last", "info"}
+        self._writing = set() # video ids being teed right now
+        self._save_handle = None
+        self.load()
+
+    def load(self):
+        try:
+            if self.index_path.exists():
+                with open(self.index_path, 'r') as f:
+                    entries = json.load(f)
+                # Drop rows whose file is gone (manual cleanup, crash before the index was saved)
+                self._entries = {vid: e for vid, e in entries.items() if self.path(vid).exists()}
+                log.info(f"Audio cache: {len(self._entries)} tracks, {self.total_bytes() / 2**20:.0f} MB")
+            # Leftovers from streams that were interrupted by a restart
+            for part in self.dir.glob('*.part'):
+                part.unlink(missing_ok=True)
+        except Exception as e:
+            log.error(f"Failed to load audio cache index: {e}")
+
+    def save(self):
+        self._save_handle = None
+        try:
+            self.dir.mkdir(parents=True, exist_ok=True)
+            tmp = self.index_path.with_suffix('.tmp')
+            with open(tmp, 'w') as f:
+                json.dump(self._entries, f)
+            tmp.replace(self.index_path)
+        except Exception as e:
+            log.error(f"Failed to save audio cache index: {e}")
+
+    def _schedule_save(self):
+        if self._save_handle is None:
+            self._save_handle = asyncio.get_running_loop().call_later(30, self.save)
+
+    def path(self, video_id) -> Path:
+        return self.dir / f"{video_id}.ogg"
+
+    def total_bytes(self) -> int:
+        return sum(e["size"] for e in self._entries.values())
+
+    def lookup(self, video_id):
+        """Cached file for a video, or None"""
+        if video_id not in self._entries:
+            return None
+        path = self.path(video_id)
+        if path.exists():
+            return path
+        del self._entries[video_id]
+        return None
+
+    def info(self, video_id):
+        """Resolved info for a cached video pointing at the local file, so it plays with no extraction"""
+        path = self.lookup(video_id)
+        if not path:
+            return None
+        return dict(self._entries[video_id]["info"], url=str(path), acodec='opus')
+
+    def begin(self, data):
+        """Claim a .part path to tee this stream into, or None if it shouldn't be cached"""
+        video_id = data.get('id')
+        if (not self.max_bytes or not video_id or video_id in self._entries or video_id in self._writing
+                or not data.get('duration') or data['duration'] > CFG["AUDIO_CACHE_MAX_TRACK"]):
+            return None
+        try:
+            self.dir.mkdir(parents=True, exist_ok=True)
+        except OSError as e:
+            log.error(f"Audio cache unavailable: {e}")
+            return None
+        self._writing.add(video_id)
+        return self.dir / f"{video_id}.part"
+
+    def commit(self, data, part: Path, complete: bool):
+        """Keep a finished tee (or drop an interrupted one); runs on the event loop"""
+        video_id = data['id']
+        self._writing.discard(video_id)
+        try:
+            if not complete:
+                part.unlink(missing_ok=True)
+                return
+            size = part.stat().st_size
+            part.replace(self.path(video_id))
+            info = {k: data[k] for k in CACHED_INFO_FIELDS if k in data and k not in ('url', 'http_headers')}
+            self._entries[video_id] = {"size": size, "plays": 1, "last": time.time(), "info": info}
+            log.info(f"Cached {data.get('title', video_id)[:50]} ({size // 1024} KB)")
+            self._evict()
+            self._schedule_save()
+        except Exception as e:
+            log.error(f"Failed to store cached track {video_id}: {e}")
+
+    def touch(self, video_id):
+        entry = self._entries.get(video_id)
+        if entry:
+            entry["plays"] += 1
+            entry["last"] = time.time()
+            self._schedule_save()
+
+    def _evict(self):
+        total = self.total_bytes()
+        if total <= self.max_bytes:
+            return
+        weight = CFG["AUDIO_CACHE_PLAY_WEIGHT"]
+        ranked = sorted(self._entries, key=lambda vid: self._entries[vid]["last"] + self._entries[vid]["plays"] * weight)
+        for video_id in ranked:
+            if total <= self.max_bytes:
+                break
+            total -= self._entries.pop(video_id)["size"]
+            # A guild still playing this file keeps its open handle; unlink is safe
+            self.path(video_id).unlink(missing_ok=True)
+
+audio_cache = AudioCache(AUDIO_CACHE_DIR, CFG["AUDIO_CACHE_MB"] * 2**20)
+
+class QueueEntry:
+    """One queued track; slotted so thousand-track playlists stay cheap"""
+    __slots__ = ("query", "video_id", "title", "duration", "requester_id", "requester_name", "spotify_id", "isrc", "start")
+
+    def __init__(self, query, *, requester_id=0, requester_name="Unknown", title=None,
+                 duration=None, video_id=None, spotify_id=None, isrc=None, start=0):
+        self.query = query
+        self.video_id = video_id
+        self.title = title
+        self.duration = duration
+        self.requester_id = requester_id
+        self.requester_name = requester_name
+        self.spotify_id = spotify_id
+        self.isrc = isrc
+        self.start = start  # seconds in; set when a parked track is put back to resume later
+
+    @property
+    def display(self) -> str:
+        return self.title or self.query
+
+    @property
+    def lookup_query(self) -> str:
+        """What to hand yt-dlp: the known YouTube video when there is one, else the search text"""
+        if not self.video_id and self.spotify_id:
+            self.video_id = spotify_matches.lookup(self.spotify_id, self.isrc)
+        if self.video_id:
+            return f"https://www.youtube.com/watch?v={self.video_id}"
+        return self.query
+
+    @property
+    def key(self) -> str:
+        """Identity used for dedupe: the resolved video if known, else the query"""
+        if self.video_id:
+            return f"yt:{self.video_id}"
+        if self.spotify_id:
+            return f"sp:{self.spotify_id}"
+        return ResolveCache.normalize(self.query)
+
+    def update_from(self, data: dict):
+        """Fill in metadata from a resolved info dict"""
+        self.video_id = data.get('id') or self.video_id
+        self.title = data.get('title') or self.title
+        self.duration = data.get('duration') or self.duration
+
+class MusicQueue:
+    """Per-guild play queue backed by a deque: O(1) pops from the front, cheap reorders"""
+    def __init__(self):
+        self._entries = deque()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        return iter(self._entries)
+
+    def append(self, entry: QueueEntry):
+        self._entries.append(entry)
+
+    def appendleft(self, entry: QueueEntry):
+        self._entries.appendleft(entry)
+
+    def extend(self, entries):
+        self._entries.extend(entries)
+
+    def popleft(self) -> QueueEntry:
+        return self._entries.popleft()
+
+    def peek(self, count: int) -> list:
+        """The first `count` entries without copying the whole queue"""
+        return list(islice(self._entries, count))
+
+    def remove(self, index: int) -> QueueEntry:
+        entry = self._entries[index]
+        del self._entries[index]
+        return entry
+
+    def move(self, src: int, dst: int) -> QueueEntry:
+        entry = self.remove(src)
+        self._entries.insert(dst, entry)
+        return entry
+
+    def dedupe(self) -> int:
+        """Drop repeated tracks, keeping the first occurrence; returns how many were removed"""
+        seen = set()
+        kept = deque()
+        for entry in self._entries:
+            if entry.key not in seen:
+                seen.add(entry.key)
+                kept.append(entry)
+        removed = len(self._entries) - len(kept)
+        self._entries = kept
+        return removed
+
+    def shuffle(self):
+        # Indexing a deque is O(n), so shuffle a list copy instead of in place
+        entries = list(self._entries)
+        random.shuffle(entries)
+        self._entries = deque(entries)
+
+    def clear(self):
+        self._entries.clear()
+
+def get_queue(guild_id) -> MusicQueue:
+    return music_queues.setdefault(guild_id, MusicQueue())
+
+class PlayHistory:
+    """Recent plays for one guild: a ring buffer with O(1) lookup by play number
+
+    Plays pushed out of the buffer are appended to a JSONL file when `spill` is set, so
+    old numbers stay replayable without being held in memory. The file rotates at
+    HISTORY_SPILL_KB, keeping one previous generation, and is only searched in an executor.
+    """
+    def __init__(self, size: int, spill: Path = None):
+        self._recent = deque(maxlen=size)
+        self._by_index = {}  # play number: track info
+        self.spill = spill
+
+    def __len__(self):
+        return len(self._recent)
+
+    def __iter__(self):
+        return iter(self._recent)
+
+    def append(self, track: dict):
+        if len(self._recent) == self._recent.maxlen:
+            oldest = self._recent[0]
+            self._by_index.pop(oldest['index'], None)
+            self._spill(oldest)
+        self._recent.append(track)
+        self._by_index[track['index']] = track
+
+    def get(self, index: int):
+        """A play still in memory, or None"""
+        return self._by_index.get(index)
+
+    async def lookup(self, index: int):
+        """A play by number, searching the spill files off the event loop if it has aged out"""
+        track = self._by_index.get(index)
+        if track is None and self.spill and (not self._recent or index < self._recent[0]['index']):
+            track = await asyncio.get_running_loop().run_in_executor(None, self._search_spill, index)
+        return track
+
+    @property
+    def rotated(self) -> Path:
+        return self.spill.with_suffix(".1.jsonl")
+
+    def flush(self):
+        """Spill everything still in memory and empty the buffer (before the history is dropped)"""
+        self._spill(*self._recent)
+        self._recent.clear()
+        self._by_index.clear()
+
+    def _spill(self, *tracks: dict):
+        if not self.spill or not tracks:
+            return
+        try:
+            self.spill.parent.mkdir(parents=True, exist_ok=True)
+            with open(self.spill, 'a') as f:
+                f.writelines(json.dumps(track) + "\n" for track in tracks)
+                size = f.tell()
+            if size > CFG["HISTORY_SPILL_KB"] * 1024:
+                os.replace(self.spill, self.rotated)
+        except Exception as e:
+            log.error(f"Failed to spill play history: {e}")
+
+    def _search_spill(self, index: int):
+        # Numbering restarts with the bot, so the newest line with this number wins
+        for path in (self.spill, self.rotated):
+            found = None
+            try:
+                if path.exists():
+                    with open(path, 'r') as f:
+                        for line in f:
+                            track = json.loads(line)
+                            if track.get('index') == index:
+                                found = track
+            except Exception as e:
+                log.error(f"Failed to read spilled play history: {e}")
+            if found:
+                return found
+        return None
+
+def get_history(guild_id) -> PlayHistory:
+    if guild_id not in played_history:
+        spill = HISTORY_DIR / f"{guild_id}.jsonl" if CFG["HISTORY_SPILL"] else None
+        played_history[guild_id] = PlayHistory(CFG["HISTORY_SIZE"], spill)
+    return played_history[guild_id]
+
+FRAME_SECONDS = 0.02  # Every read() from a voice source is one 20ms frame
+OPUS_SILENCE = b'\xf8\xff\xfe'
+PCM_SILENCE = b'\x00' * discord.opus.Encoder.FRAME_SIZE
+VOICE_GAP_FRAMES = 25  # A mixed line silent this long (0.5s) lets the music back up until it resumes
+
+class TrackAudio:
+    """Bookkeeping shared by music sources: playback position and a read-ahead buffer"""
+    def _init_track(self, data, seek):
         self.data = data
         self.title = data.get('title')
         self.url = data.get('url')
+        self.seek = seek
+        self.frames = 0
+        self._buffer = deque()
+
+    @property
+    def position(self) -> float:
+        """Seconds into the track"""
+        return self.seek + self.frames * FRAME_SECONDS
+
+    @property
+    def remaining(self):
+        """Seconds left by the extractor's duration, or None when unknown"""
+        duration = self.data.get('duration')
+        return duration - self.position if duration else None
+
+    def prebuffer(self, frames: int) -> int:
+        """Blocking read-ahead so the first frames after a track switch are already in memory"""
+        while len(self._buffer) < frames:
+            ret = self._read_frame()
+            if not ret:
+                break
+            self._buffer.append(ret)
+        return len(self._buffer)
+
+    def read(self) -> bytes:
+        ret = self._buffer.popleft() if self._buffer else self._read_frame()
+        if ret:
+            self.frames += 1
+        return ret
+
+class YTDLSource(TrackAudio, discord.PCMVolumeTransformer):
+    def __init__(self, source, *, data, volume=1.15, seek=0):
+        super().__init__(source, volume)
+        self._init_track(data, seek)
+
+    def _read_frame(self) -> bytes:
+        return discord.PCMVolumeTransformer.read(self)
 
     @classmethod
-    async def from_url(cls, url, *, loop=None, stream=True):
-        loop = loop or asyncio.get_event_loop()
+    async def extract(cls, url, *, guild_id=0, lane=LANE_INTERACTIVE, job=None):
+        """Run yt-dlp for a query on the extraction scheduler and return the first result's info dict"""
         
-        def extract_info():
+        def extract_info(ydl):
             try:
-                with yt_dlp.YoutubeDL(ytdl_options) as ydl:
-                    info = ydl.extract_info(url, download=not stream)
-                    if not info:
-                        return None
-                    return info
+                info = ydl.extract_info(url, download=False)
             except Exception as e:
                 log.error("YT-DLP extraction error: %s", e)
                 return None
+            if info and 'entries' in info:
+                info = next((e for e in info['entries'] if e), None)
+            return info
         
-        data = await loop.run_in_executor(None, extract_info)
+        future = extractor.submit(extract_info, guild_id=guild_id, lane=lane)
+        if job is not None:
+            job.append(future)
+        data = await future
         
         if not data:
             raise Exception("Could not extract audio info")
-            
-        if 'entries' in data:
-            data = data['entries'][0]
+        return data
+
+    @classmethod
+    async def resolve(cls, url, *, guild_id=0, lane=LANE_INTERACTIVE):
+        """Return stream info for a query, served from the resolve cache when fresh"""
+        data = resolve_cache.get(url)
+        if data:
+            return data
+        key = resolve_cache.normalize(url)
+        if key.startswith("yt:"):
+            data = audio_cache.info(key[3:])
+            if data:
+                return data
+        if key in inflight_resolves:
+            task, job = inflight_resolves[key]
+            if job:
+                extractor.promote(job[0], lane)
+        else:
+            job = []
+            async def run():
+                try:
+                    data = await cls.extract(url, guild_id=guild_id, lane=lane, job=job)
+                    return resolve_cache.put(url, data)
+                finally:
+                    inflight_resolves.pop(key, None)
+            task = asyncio.ensure_future(run())
+            inflight_resolves[key] = (task, job)
+        # Shielded so cancelling one waiter (e.g. a prefetch) doesn't abort the shared extraction
+        return await asyncio.shield(task)
 
-        filename = data['url'] if stream else yt_dlp.YoutubeDL(ytdl_options).prepare_filename(data)
+    @classmethod
+    def create(cls, data, *, volume=None, seek=0, pcm=False):
+        """Build the playable source for resolved info (the audio cache's file when it has one)
+
+        Opus input at unity volume is remuxed straight through; anything needing DSP
+        (a volume change) goes through the PCM path.
+        """
+        volume = CFG["DEF_VOL"] if volume is None else volume
+        passthrough = CFG["OPUS_PASSTHROUGH"] and not pcm and volume == 1.0
+        before_options = ffmpeg_options['before_options']
+        cached = audio_cache.lookup(data.get('id'))
+        if cached:
+            if passthrough:
+                return CachedOpusSource(cached, data=data, seek=seek)
+            # Local file: the HTTP reconnect flags would make FFmpeg refuse the input
+            filename, before_options = str(cached), '-nostdin'
+        else:
+            filename = data['url']
+        if seek:
+            before_options += f" -ss {seek:.2f}"
+
+        if passthrough and data.get('acodec') == 'opus':
+            tee = None if seek else audio_cache.begin(data)
+            try:
+                return YTDLOpusSource(filename, data=data, before_options=before_options, seek=seek, tee=tee)
+            except Exception as e:
+                if tee:
+                    audio_cache.commit(data, tee, False)
+                log.error("Opus passthrough failed, falling back to PCM: %s", e)
         
         # IMPROVED: Better error handling for audio source creation
         try:
             source = discord.FFmpegPCMAudio(
                 filename, 
-                **ffmpeg_options, 
+                before_options=before_options,
+                options=ffmpeg_options['options'],
                 executable=CFG["FFMPEG_PATH"]
             )
-            return cls(source, data=data, volume=CFG["DEF_VOL"])
+            return cls(source, data=data, volume=volume, seek=seek)
         except Exception as e:
             log.error("FFmpeg audio source creation failed: %s", e)
             # Fallback: try without specific options
@@ -783,11 +1955,414 @@ class YTDLSource(discord.PCMVolumeTransformer):
                     filename, 
                     executable=CFG["FFMPEG_PATH"]
                 )
-                return cls(source, data=data, volume=CFG["DEF_VOL"])
+                return cls(source, data=data, volume=volume)
             except Exception as e2:
                 log.error("Fallback FFmpeg also failed: %s", e2)
                 raise Exception(f"Audio source creation failed: {str(e)}")
 
+class YTDLOpusSource(TrackAudio, discord.FFmpegOpusAudio):
+    """Passthrough source: YouTube's Opus packets are remuxed to Discord with no decode or re-encode
+
+    With `tee`, the same FFmpeg also writes the packets to that file (discord.py's output
+    options become the file's, then the pipe gets its own), filling the audio cache.
+    """
+    def __init__(self, filename, *, data, before_options, seek=0, tee=None):
+        options = '-vn'
+        if tee:
+            options = f"-vn {shlex.quote(str(tee))} -map_metadata -1 -f opus -c:a copy -vn"
+        super().__init__(
+            filename,
+            codec='copy',
+            executable=CFG["FFMPEG_PATH"],
+            before_options=before_options,
+            options=options,
+        )
+        self._init_track(data, seek)
+        self._tee = tee
+        self._eof = False
+
+    def _read_frame(self) -> bytes:
+        ret = discord.FFmpegOpusAudio.read(self)
+        # The Ogg header packets aren't audio; don't send them to Discord
+        while ret[:8] in (b'OpusHead', b'OpusTags'):
+            ret = discord.FFmpegOpusAudio.read(self)
+        if not ret:
+            self._eof = True
+        return ret
+
+    def cleanup(self):
+        proc = self._process
+        super().cleanup()
+        if self._tee:
+            # Only a stream FFmpeg finished by itself is a whole file; a skip leaves a fragment,
+            # and a dropped connection can end "cleanly" well short of the duration
+            remaining = self.remaining
+            complete = self._eof and proc and proc.returncode == 0 and (remaining is None or remaining < 2)
+            bot.loop.call_soon_threadsafe(audio_cache.commit, self.data, self._tee, complete)
+            self._tee = None
+
+class CachedOpusSource(TrackAudio, discord.AudioSource):
+    """Plays a cached Ogg Opus file by reading its packets directly: no FFmpeg, no network"""
+    def __init__(self, path, *, data, seek=0):
+        self._file = open(path, 'rb')
+        self._packets = OggStream(self._file).iter_packets()
+        self._init_track(data, seek)
+        # YouTube's Opus uses 20ms packets, so seeking is skipping packets
+        for _ in range(int(seek / FRAME_SECONDS)):
+            if not self._read_frame():
+                break
+
+    def is_opus(self) -> bool:
+        return True
+
+    def _read_frame(self) -> bytes:
+        for packet in self._packets:
+            if packet[:8] not in (b'OpusHead', b'OpusTags'):
+                return packet
+        return b''
+
+    def cleanup(self):
+        self._file.close()
+
+class GaplessSource(discord.AudioSource):
+    """Long-lived per-guild music source that hands over to a pre-opened next track
+
+    The switch happens on the frame the current track runs dry, so there is no gap for
+    FFmpeg spawn or HTTP connect. With CROSSFADE_SECONDS set, the tail of the current
+    track is blended into the head of the next (PCM sources only).
+
+    A stream that dies well before its duration (expired googlevideo URL, 403) is not
+    treated as the end: silence is served while the track is re-resolved and reopened
+    at the same position.
+    """
+    def __init__(self, guild_id, track, entry):
+        self.guild_id = guild_id
+        self.current = track
+        self.entry = entry
+        self.next = None
+        self.next_entry = None
+        self.finished = False
+        self._preroll_sent = False
+        self._opus = track.is_opus()
+        self._recover_attempts = 0
+        self._recover_deadline = None
+        self._interjection = None  # (source, done callback, mixed) played over the track
+        self._retired = None  # Replaced tracks for the audio thread to clean up
+        self._gain = 1.0  # Music gain, below 1 while ducked under a line
+        self._voice_gap = 0  # Frames in a row the mixed line has had nothing buffered
+        self._decoders = {}  # "music": opus.Decoder for mixing passthrough frames
+        self._lock = threading.Lock()
+
+    def set_next(self, track, entry) -> bool:
+        with self._lock:
+            if self.finished or self.next:
+                return False
+            self.next, self.next_entry = track, entry
+            return True
+
+    def drop_next(self, track) -> bool:
+        """Detach a preloaded track that is being discarded; False if it has already started playing"""
+        with self._lock:
+            if self.current is track:
+                return False
+            if self.next is track:
+                self.next = self.next_entry = None
+            return True
+
+    def swap_current(self, track):
+        """Replace the playing track (e.g. same stream reopened on the PCM path)
+
+        The audio thread may be mid-read of the old track, so it cleans it up itself once it
+        has moved on to the new one.
+        """
+        with self._lock:
+            self._retire(self.current)
+            self.current = track
+            self._recover_deadline = None
+
+    def _retire(self, track):
+        # Caller holds the lock
+        if self._retired:
+            self._retired.append(track)
+        else:
+            self._retired = [track]
+
+    def interject(self, source, done, mix=True) -> bool:
+        """Play `source` over the music, ducked under it when `mix`, else held at its position
+
+        `done()` runs on the audio thread once the source is exhausted. A mixed source must be
+        a VoiceBuffer, so the music is never kept waiting on it. Mixing yields PCM, so the
+        voice client needs an encoder.
+        """
+        with self._lock:
+            if self.finished or self._interjection:
+                return False
+            self._interjection = (source, done, mix)
+            self._voice_gap = 0
+            self._decoders.clear()
+            return True
+
+    def _read_overlay(self, source) -> bytes:
+        try:
+            return source.read()
+        except Exception as e:
+            log.error("Interjection error: %s", e)
+            return b''
+
+    def _end_interjection(self):
+        with self._lock:
+            source, done, _ = self._interjection
+            self._interjection = None
+        source.cleanup()
+        done()
+
+    def _read_interjection(self) -> bytes:
+        source = self._interjection[0]
+        ret = self._read_overlay(source)
+        if ret:
+            self._opus = source.is_opus()
+            return ret
+        self._end_interjection()
+        # Music picks up on the next frame, after `done` has had a chance to pause the player
+        return OPUS_SILENCE if self._opus else PCM_SILENCE
+
+    def _decode(self, name, frame) -> bytes:
+        if name not in self._decoders:
+            self._decoders[name] = discord.opus.Decoder()
+        return self._decoders[name].decode(frame, fec=False)
+
+    def _read_mixed(self) -> bytes:
+        interjection = self._interjection
+        voice = None
+        if interjection:
+            voice = interjection[0].take()
+            if voice == b'':
+                self._end_interjection()
+        # A line that falls behind is silence for that frame, with the music kept ducked under it;
+        # a longer gap (a long line waiting on its next piece) brings the music back meanwhile
+        self._voice_gap = 0 if voice else self._voice_gap + 1
+        voice = voice or b''
+        # Slide the music gain a step towards its target each frame so ducking never clicks
+        ducked = self._interjection and self._voice_gap < VOICE_GAP_FRAMES
+        target = CFG["TTS_DUCK"] if ducked else 1.0
+        step = FRAME_SECONDS / max(CFG["TTS_DUCK_RAMP"], FRAME_SECONDS)
+        self._gain = max(target, self._gain - step) if self._gain > target else min(target, self._gain + step)
+
+        music = self._read_music()
+        if not music and not voice and not self._interjection:
+            return b''
+        if music and self._opus:
+            music = self._decode("music", music)
+        self._opus = False
+        size = discord.opus.Encoder.FRAME_SIZE
+        music = audioop.mul(music[:size].ljust(size, b'\0'), 2, self._gain)
+        if not voice:
+            return music
+        return audioop.add(music, voice[:size].ljust(size, b'\0'), 2)
+
+    def resume(self, lost, track) -> bool:
+        """Put a recovered stream in place of the one that died, unless playback moved on meanwhile"""
+        with self._lock:
+            if self.finished or self.current is not lost:
+                return False
+            self._retire(lost)
+            self.current = track
+            self._recover_deadline = None
+            return True
+
+    def give_up(self, lost):
+        """Recovery of `lost` failed: end it on the next frame instead of waiting out the timeout"""
+        with self._lock:
+            if self.current is lost and self._recover_deadline is not None:
+                self._recover_deadline = 0
+
+    def _should_recover(self, current) -> bool:
+        remaining = current.remaining
+        return (
+            isinstance(current, (YTDLSource, YTDLOpusSource))
+            and current.data.get('url', '').startswith('http')
+            and remaining is not None and remaining > 5
+            and self._recover_attempts < CFG["STREAM_RECOVER_ATTEMPTS"]
+        )
+
+    def is_opus(self) -> bool:
+        # Tracks may alternate between passthrough and PCM, so report what the last frame was
+        return self._opus
+
+    def _read_current(self, current, nxt) -> bytes:
+        remaining = current.remaining
+        if not self._preroll_sent and remaining is not None and remaining <= max(CFG["GAPLESS_PREROLL"], CFG["CROSSFADE_SECONDS"] + 2):
+            self._preroll_sent = True
+            bot.loop.call_soon_threadsafe(on_track_preroll, self)
+        fade = CFG["CROSSFADE_SECONDS"]
+        if nxt and fade and remaining is not None and remaining <= fade and not (current.is_opus() or nxt.is_opus()):
+            ret = current.read()
+            head = nxt.read() if ret else b''
+            if head:
+                gain = max(0.0, min(1.0, remaining / fade))
+                return audioop.add(audioop.mul(ret, 2, gain), audioop.mul(head, 2, 1.0 - gain), 2)
+            return ret
+        return current.read()
+
+    def read(self) -> bytes:
+        interjection = self._interjection
+        if interjection and not interjection[2]:
+            return self._read_interjection()
+        if interjection or self._gain < 1.0:
+            return self._read_mixed()
+        return self._read_music()
+
+    def _read_music(self) -> bytes:
+        with self._lock:
+            current, nxt = self.current, self.next
+            retired, self._retired = self._retired, None
+        # The previous read has returned, so nothing is using these any more
+        for track in retired or ():
+            track.cleanup()
+        ret = self._read_current(current, nxt)
+        if not ret and self._recover_deadline is None and self._should_recover(current):
+            self._recover_attempts += 1
+            self._recover_deadline = time.monotonic() + CFG["STREAM_RECOVER_TIMEOUT"]
+            bot.loop.call_soon_threadsafe(on_stream_lost, self, current)
+        if not ret and self._recover_deadline is not None:
+            if time.monotonic() < self._recover_deadline:
+                return OPUS_SILENCE if self._opus else PCM_SILENCE
+            # Recovery didn't land in time; let the track end
+            self._recover_deadline = None
+            self._recover_attempts = CFG["STREAM_RECOVER_ATTEMPTS"]
+        if not ret:
+            # Current track is exhausted: switch on this very frame if the next one is ready
+            with self._lock:
+                nxt, entry = self.next, self.next_entry
+                if nxt is None:
+                    return b''
+                self.current, self.entry = nxt, entry
+                self.next = self.next_entry = None
+                self._preroll_sent = False
+                self._recover_attempts = 0
+            current.cleanup()
+            bot.loop.call_soon_threadsafe(on_track_advance, self, nxt, entry)
+            ret = nxt.read()
+            current = nxt
+        self._opus = current.is_opus()
+        return ret
+
+    def cleanup(self):
+        # The preloaded next track is owned by `preloads`, so a skip can still use it
+        with self._lock:
+            self.finished = True
+            current = self.current
+            interjection, self._interjection = self._interjection, None
+            retired, self._retired = self._retired, None
+        current.cleanup()
+        for track in retired or ():
+            track.cleanup()
+        if interjection:
+            source, done, _ = interjection
+            source.cleanup()
+            done()
+
+class VoiceBuffer(discord.AudioSource):
+    """Reads a TTS line or clip ahead on its own thread, so mixing it over music never blocks
+
+    The audio thread only takes frames that are already here; a shortfall (a streamed render
+    waiting on edge-tts, say) is silence in the mix rather than a stall of the music.
+    Opus clip packets are decoded to PCM here too.
+    """
+    AHEAD = 50  # Frames (1s) read ahead of playback
+
+    def __init__(self, source):
+        self.source = source
+        self._frames = deque()
+        self._eof = False
+        self._closed = False
+        self._cond = threading.Condition()
+        self._decoder = discord.opus.Decoder() if source.is_opus() else None
+        threading.Thread(target=self._fill, daemon=True).start()
+
+    def _fill(self):
+        try:
+            while True:
+                with self._cond:
+                    self._cond.wait_for(lambda: self._closed or len(self._frames) < self.AHEAD)
+                    if self._closed:
+                        return
+                frame = self.source.read()
+                if frame and self._decoder:
+                    frame = self._decoder.decode(frame, fec=False)
+                with self._cond:
+                    if not frame:
+                        return
+                    self._frames.append(frame)
+                    self._cond.notify_all()
+        except Exception as e:
+            if not self._closed:
+                log.error("TTS buffer error: %s", e)
+        finally:
+            with self._cond:
+                self._eof = True
+                self._cond.notify_all()
+
+    def wait_ready(self, frames: int, timeout: float) -> bool:
+        """Block (in an executor) until `frames` are buffered or the source has ended"""
+        with self._cond:
+            return self._cond.wait_for(lambda: len(self._frames) >= frames or self._eof, timeout)
+
+    def take(self):
+        """A buffered frame, b'' once the source is exhausted, or None if it is behind"""
+        with self._cond:
+            if self._frames:
+                self._cond.notify_all()
+                return self._frames.popleft()
+            return b'' if self._eof else None
+
+    def is_opus(self) -> bool:
+        return False
+
+    def read(self) -> bytes:
+        with self._cond:
+            self._cond.wait_for(lambda: self._frames or self._eof)
+            self._cond.notify_all()
+            return self._frames.popleft() if self._frames else b''
+
+    def cleanup(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self.source.cleanup()
+
+def ensure_encoder(vc):
+    """A player started on an Opus source has no encoder; create one before feeding it PCM"""
+    if not vc.encoder:
+        vc.encoder = discord.opus.Encoder()
+
+def set_music_volume(guild, volume) -> bool:
+    """Apply a guild's music volume, moving a passthrough stream onto the PCM path if needed"""
+    guild_volumes[guild.id] = volume
+    vc = guild.voice_client
+    source = vc.source if vc else None
+    gapless = source if isinstance(source, GaplessSource) else None
+    if gapless:
+        source = gapless.current
+        if isinstance(gapless.next, YTDLSource):
+            gapless.next.volume = volume
+    if isinstance(source, YTDLSource):
+        source.volume = volume
+        return True
+    if isinstance(source, (YTDLOpusSource, CachedOpusSource)):
+        if volume == 1.0:
+            return True
+        # Reopen the already-resolved stream at the current position; no re-extraction
+        pcm = YTDLSource.create(source.data, volume=volume, seek=source.position)
+        ensure_encoder(vc)
+        if gapless:
+            gapless.swap_current(pcm)
+        else:
+            vc.source = pcm
+            source.cleanup()
+        return True
+    return False
+
 # -------------------------------------------------
 # 5.  EVENTS
 # -------------------------------------------------
@@ -813,15 +2388,20 @@ async def on_ready():
             log.info("Slash commands synced")
         except Exception as e:
             log.warning(f"Failed to sync slash commands: {e}")
-    # Only start cleanup task if not already running
-    if not cleanup_task.is_running():
-        cleanup_task.start()
+    # Warm the yt-dlp workers so the first !play doesn't pay for extractor setup
+    extractor.start()
+    # Pre-encode the sound-effect clips so they play without FFmpeg
+    clip_bank.start()
 
 @bot.event
 async def on_voice_state_update(member, before, after):
-    """Handle voice state changes - bot stays in channel permanently"""
-    # Bot no longer auto-disconnects when alone
-    pass
+    """Park the voice client when its channel empties out; rejoin when someone comes back"""
+    guild = member.guild
+    if after.channel and after.channel != before.channel and not member.bot:
+        if parked_guilds.get(guild.id) == after.channel.id:
+            await unpark(guild, after.channel)
+            return
+    update_idle(guild)
 
 @bot.event
 async def on_disconnect():
@@ -874,18 +2454,144 @@ async def on_message(message):
 # -------------------------------------------------
 # 6.  LOOPS
 # -------------------------------------------------
-@tasks.loop(minutes=45)  # Cleanup every 45 minutes
-async def cleanup_task():
-    await tts.cleanup_old()
-
-@cleanup_task.before_loop
-async def before_cleanup():
-    await bot.wait_until_ready()
+# None: TTS scratch files are reclaimed as soon as they are released (see TTSSpool)
 
 # -------------------------------------------------
 # 7.  TTS COMMANDS (IMPROVED)
 # -------------------------------------------------
-tts = TTSEngine(Path(CFG["TEMP_FOLDER"]))
+tts = TTSEngine(TTSSpool(spool_dir(), CFG["TTS_SPOOL_MB"] * 2**20), Path(CFG["TTS_CACHE_FOLDER"]), CFG["TTS_CACHE_MB"] * 2**20)
+
+# Fixed sound-effect phrases served from the clip bank
+SOUND_CLIPS = {
+    "moan": ("girl", "Ahhhh... *moans*"),
+    "scream": ("girl", "KYAAAAAAAAA! AHHHHHHHH!"),
+    "laughaudio": ("girl", "Hahahahaha! Hehehehe! Fufufufu~"),
+    "nekoaudio": ("child", "Nya nya~ Meow meow~ Nyan nyan~"),
+}
+
+class ClipSource(discord.AudioSource):
+    """Plays a bank clip's Opus packets as they are"""
+    def __init__(self, packets):
+        self._packets = iter(packets)
+
+    def is_opus(self) -> bool:
+        return True
+
+    def read(self) -> bytes:
+        return next(self._packets, b'')
+
+class ClipBank:
+    """Sound-effect phrases pre-encoded to Opus packets and held in memory
+
+    Each clip is rendered through the TTS cache and encoded once, then persisted with the
+    others in a single file. Playing one hands its packets straight to Discord: no FFmpeg
+    process, no decode, no encode.
+    """
+    MAGIC = b"ASHCLIP1"
+
+    def __init__(self, path: Path, clips: dict):
+        self.path = path
+        self.clips = clips  # name: (character, text)
+        self._packets = {}  # name: list of Opus packets
+        self._index = {}    # name: {"profile", "lengths"} as persisted
+        self._building = None
+        self.load()
+
+    def profile(self, name) -> str:
+        """What a clip's packets depend on; a change in voice, text or TTS_VOL rebuilds it"""
+        character, text = self.clips[name]
+        cfg = DS_VOICES.get(character, DS_VOICES["girl"])
+        return hashlib.sha1(f"{TTSEngine.cache_key(cfg, text)}|{CFG['TTS_VOL']}".encode()).hexdigest()
+
+    def get(self, name):
+        return self._packets.get(name)
+
+    def load(self):
+        try:
+            if not self.path.exists():
+                return
+            data = self.path.read_bytes()
+            if data[:8] != self.MAGIC:
+                raise ValueError("not a clip bank")
+            size = int.from_bytes(data[8:12], 'big')
+            index = json.loads(data[12:12 + size])
+            pos = 12 + size
+            for name, clip in index.items():
+                packets = []
+                for length in clip["lengths"]:
+                    packets.append(data[pos:pos + length])
+                    pos += length
+                if name in self.clips and clip["profile"] == self.profile(name):
+                    self._packets[name] = packets
+                    self._index[name] = clip
+            log.info(f"Loaded {len(self._packets)} sound clips")
+        except Exception as e:
+            log.error(f"Failed to load clip bank: {e}")
+
+    def save(self):
+        try:
+            self.path.parent.mkdir(exist_ok=True)
+            header = json.dumps(self._index).encode()
+            tmp = self.path.with_suffix('.tmp')
+            with open(tmp, 'wb') as f:
+                f.write(self.MAGIC + len(header).to_bytes(4, 'big') + header)
+                for name in self._index:
+                    f.write(b"".join(self._packets[name]))
+            tmp.replace(self.path)
+        except Exception as e:
+            log.error(f"Failed to save clip bank: {e}")
+
+    def start(self):
+        """Build any missing clips in the background; commands use live TTS until then"""
+        if self._building is None or self._building.done():
+            self._building = asyncio.create_task(self.build())
+
+    async def build(self):
+        built = 0
+        for name, (character, text) in self.clips.items():
+            if name in self._packets:
+                continue
+            try:
+                packets = await self._encode(await tts.file(text, character))
+            except Exception as e:
+                log.error(f"Failed to build sound clip {name}: {e}")
+                continue
+            self._packets[name] = packets
+            self._index[name] = {"profile": self.profile(name), "lengths": [len(p) for p in packets]}
+            built += 1
+        if built:
+            self.save()
+            log.info(f"Built {built} sound clips")
+
+    async def _encode(self, mp3_path: Path):
+        """One-time FFmpeg run: mp3 -> 20ms Opus packets at TTS volume"""
+        proc = await asyncio.create_subprocess_exec(
+            CFG["FFMPEG_PATH"], '-nostdin', '-loglevel', 'error', '-i', str(mp3_path),
+            '-af', f'volume={CFG["TTS_VOL"]}', '-c:a', 'libopus', '-b:a', '128k',
+            '-ar', '48000', '-ac', '2', '-frame_duration', '20', '-f', 'opus', 'pipe:1',
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        )
+        out, err = await proc.communicate()
+        if proc.returncode != 0:
+            raise Exception(err.decode(errors='ignore').strip() or f"ffmpeg exited with {proc.returncode}")
+        return [p for p in OggStream(io.BytesIO(out)).iter_packets() if p[:8] not in (b'OpusHead', b'OpusTags')]
+
+clip_bank = ClipBank(CLIP_BANK_FILE, SOUND_CLIPS)
+
+async def wait_voice_ready(vc, timeout) -> bool:
+    """Wait for the voice handshake to finish; discord.py sets an event when it does"""
+    if vc.is_connected():
+        return True
+    return await asyncio.get_running_loop().run_in_executor(None, vc.wait_until_connected, timeout)
+
+def record_voice_latency(guild_id, kind, started, attempt):
+    stats = voice_connect_stats.setdefault(guild_id, deque(maxlen=20))
+    stats.append(time.monotonic() - started)
+    ordered = sorted(stats)
+    log.info(
+        f"Voice {kind} ready in {stats[-1] * 1000:.0f} ms (attempt {attempt}, guild {guild_id}; "
+        f"median {ordered[len(ordered) // 2] * 1000:.0f} ms, max {ordered[-1] * 1000:.0f} ms over {len(stats)})"
+    )
 
 async def ensure_voice_client(ctx):
     """Ensure bot is connected to voice channel with better error handling"""
@@ -895,6 +2601,9 @@ async def ensure_voice_client(ctx):
 
     vc = ctx.voice_client
     target_channel = ctx.author.voice.channel
+    guild_id = ctx.guild.id
+    # A command brings a parked guild back on its own terms
+    parked_guilds.pop(guild_id, None)
     
     # If already connected to the same channel, return it
     if vc and vc.channel == target_channel:
@@ -904,31 +2613,35 @@ async def ensure_voice_client(ctx):
     if vc and vc.channel != target_channel:
         # Check if we can have multiple connections (one bot = one voice connection per guild)
         # Discord limitation: One bot can only be in ONE voice channel per server
+        started = time.monotonic()
         try:
-            await vc.move_to(target_channel)
-            await asyncio.sleep(0.5)
-            return vc
+            # move_to returns once the gateway confirms the new channel
+            await vc.move_to(target_channel, timeout=CFG["VOICE_CONNECT_TIMEOUT"])
+            if await wait_voice_ready(vc, CFG["VOICE_CONNECT_TIMEOUT"]):
+                record_voice_latency(guild_id, "move", started, 1)
+                return vc
+        except Exception as e:
+            log.error(f"Voice move failed: {e}")
+        try:
+            await vc.disconnect(force=True)
         except:
-            try:
-                await vc.disconnect(force=True)
-                await asyncio.sleep(0.5)
-            except:
-                pass
+            pass
     
     # Connect to voice channel with retry logic
-    max_retries = 3
+    max_retries = CFG["VOICE_CONNECT_RETRIES"]
     for attempt in range(max_retries):
+        started = time.monotonic()
         try:
+            # connect() returns when the voice handshake is done; no fixed settle delay needed
             vc = await target_channel.connect(
-                timeout=60.0,  # Increased from 30 to 60 seconds
+                timeout=CFG["VOICE_CONNECT_TIMEOUT"],
                 reconnect=True,
                 cls=FixedVoiceClient,
                 self_deaf=False
             )
-            await asyncio.sleep(2.0)  # Increased wait time
             
-            if vc.is_connected():
-                log.info(f"Successfully connected to voice channel on attempt {attempt + 1}")
+            if await wait_voice_ready(vc, CFG["VOICE_CONNECT_TIMEOUT"]):
+                record_voice_latency(guild_id, "connect", started, attempt + 1)
                 return vc
             else:
                 raise Exception("Connection established but not connected")
@@ -939,64 +2652,197 @@ async def ensure_voice_client(ctx):
                     return ctx.guild.voice_client
             log.error(f"Voice connection attempt {attempt + 1} failed: {str(e)}")
             if attempt < max_retries - 1:
-                await asyncio.sleep(3)  # Longer delay between retries
+                await asyncio.sleep(voice_retry_delay(attempt))
             else:
                 await ctx.send(f"❌ Failed to join voice channel after {max_retries} attempts. Check bot permissions and try again.")
                 return None
         except Exception as e:
             log.error(f"Voice connection attempt {attempt + 1} failed: {str(e)}")
             if attempt < max_retries - 1:
-                await asyncio.sleep(3)  # Longer delay between retries
+                await asyncio.sleep(voice_retry_delay(attempt))
             else:
                 await ctx.send(f"❌ Failed to join voice channel. Error: {type(e).__name__}")
                 return None
     
     return None
 
+def voice_retry_delay(attempt) -> float:
+    """Exponential backoff with full jitter: 0-1s, 0-2s, 0-4s, ..."""
+    return random.uniform(0, min(2 ** attempt, 16))
+
+class Utterance:
+    """One queued TTS line or sound effect; `open()` builds its AudioSource when its turn comes"""
+    __slots__ = ("key", "ctx", "announce", "open")
+
+    def __init__(self, key, ctx, announce, open):
+        self.key = key
+        self.ctx = ctx
+        self.announce = announce
+        self.open = open
+
+VOICE_PRIME_FRAMES = 10  # Frames a mixed line buffers before it starts
+VOICE_PRIME_TIMEOUT = 5  # ... or seconds it may take to; after that it starts and catches up
+
+class TTSQueue:
+    """Speaks a guild's TTS lines and sound effects one after another
+
+    Music is never stopped for a line: a playing GaplessSource mixes the line over its track,
+    ducked by TTS_DUCK (or holds the track where it is while paused), so the stream carries on
+    without re-extraction. Rapid repeats of a line that is already waiting, or that just started, are merged into it.
+    """
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.pending = deque()
+        self.last = (None, 0.0)  # key and start time of the line spoken last
+        self.task = None
+
+    def __len__(self):
+        return len(self.pending)
+
+    def is_duplicate(self, key) -> bool:
+        last_key, started = self.last
+        if last_key == key and time.monotonic() - started < CFG["TTS_COALESCE_SECONDS"]:
+            return True
+        return any(u.key == key for u in self.pending)
+
+    def add(self, utterance) -> bool:
+        """Queue a line; False when it was merged into an identical one"""
+        if self.is_duplicate(utterance.key):
+            return False
+        self.pending.append(utterance)
+        if not self.task or self.task.done():
+            self.task = asyncio.create_task(self._drain())
+        return True
+
+    def clear(self):
+        self.pending.clear()
+
+    async def _drain(self):
+        while self.pending:
+            utterance = self.pending.popleft()
+            self.last = (utterance.key, time.monotonic())
+            try:
+                await self._speak(utterance)
+            except Exception as e:
+                log.error("TTS queue error: %s", e)
+        # Music that queued up while lines were spoken on their own starts now
+        if get_queue(self.guild_id):
+            get_player(self.guild_id).kick()
+
+    async def _speak(self, utterance):
+        guild = bot.get_guild(self.guild_id)
+        vc = guild.voice_client if guild else None
+        if not vc or not vc.is_connected():
+            return
+        done = asyncio.Event()
+        source = utterance.open()
+        music = vc.source
+        if isinstance(music, GaplessSource) and (vc.is_playing() or vc.is_paused()):
+            paused = vc.is_paused()
+
+            def finished():
+                # Audio thread: re-pause before the held track gets another frame out
+                if paused:
+                    vc.pause()
+                bot.loop.call_soon_threadsafe(done.set)
+
+            mix = CFG["TTS_DUCK"] is not None and not paused
+            if mix or not source.is_opus():
+                ensure_encoder(vc)
+            if mix:
+                # Let the line get a few frames ahead off the audio thread before it goes in
+                source = VoiceBuffer(source)
+                await asyncio.get_running_loop().run_in_executor(
+                    None, source.wait_ready, VOICE_PRIME_FRAMES, VOICE_PRIME_TIMEOUT)
+            if not music.interject(source, finished, mix):
+                source.cleanup()
+                return
+            if paused:
+                vc.resume()
+        else:
+            def after_playing(error):
+                if error:
+                    log.error("TTS playback error: %s", error)
+                bot.loop.call_soon_threadsafe(done.set)
+
+            # Only a leftover non-music source can be here; music is always a GaplessSource
+            if vc.is_playing() or vc.is_paused():
+                vc.stop()
+            vc.play(source, after=after_playing)
+        await utterance.ctx.send(utterance.announce)
+        await done.wait()
+
+def get_tts_queue(guild_id) -> TTSQueue:
+    if guild_id not in tts_queues:
+        tts_queues[guild_id] = TTSQueue(guild_id)
+    return tts_queues[guild_id]
+
+async def play_clip(ctx, name):
+    """Play a sound-effect clip from the bank; falls back to live TTS until it has been built"""
+    character, text = SOUND_CLIPS[name]
+    packets = clip_bank.get(name)
+    if packets is None:
+        await play_tts(ctx, character, text=text)
+        return
+    vc = await ensure_voice_client(ctx)
+    if not vc:
+        return
+    queue = get_tts_queue(ctx.guild.id)
+    if len(queue) >= CFG["TTS_QUEUE_LIMIT"] and not queue.is_duplicate(("clip", name)):
+        await ctx.send("⏳ Too many lines waiting to be spoken, try again in a moment", delete_after=5)
+        return
+    queue.add(Utterance(("clip", name), ctx, f"🔊 {character.upper()} » {text}", lambda: ClipSource(packets)))
+
 async def play_tts(ctx, character, *, text):
     vc = await ensure_voice_client(ctx)
     if not vc:
         return
 
+    key = (character, text)
+    queue = get_tts_queue(ctx.guild.id)
+    if queue.is_duplicate(key):
+        return
+    if len(queue) >= CFG["TTS_QUEUE_LIMIT"]:
+        await ctx.send("⏳ Too many lines waiting to be spoken, try again in a moment", delete_after=5)
+        return
+
+    requested = time.monotonic()
+    text = text[:CFG["MAX_TEXT"]]
+    pieces = tts.split(text, CFG["TTS_PIECE"]) or [text]
     try:
+        # Synthesis starts now, so it overlaps with whatever is spoken before this line
         async with ctx.typing():
-            mp3_path = await tts.create(text, character)
+            audio = await tts.render(pieces[0], character, ctx.guild.id)
+
+        def open_piece(audio, first=True):
+            streaming = isinstance(audio, TTSStream)
+            # HIGHEST QUALITY FFmpeg configuration for TTS
+            # A stream is piped in as edge-tts produces it; naming the format skips input probing
+            return TTSAudio(
+                audio if streaming else str(audio),
+                requested=requested if first else None,
+                kind="stream" if streaming else "cache",
+                pipe=streaming,
+                executable=CFG["FFMPEG_PATH"],
+                before_options='-nostdin -f mp3' if streaming else '-nostdin',
+                options=f'-b:a 256k -ar 48000 -ac 2 -filter:a "volume={CFG["TTS_VOL"]}"'  # Use TTS_VOL config
+            )
 
-        def after_playing(error):
-            """Callback after audio finishes playing"""
-            try:
-                # Clean up the temporary file
-                if mp3_path and mp3_path.exists():
-                    mp3_path.unlink()
-            except Exception as e:
-                log.error("Cleanup error: %s", e)
-                
-            if error:
-                log.error("TTS playback error: %s", error)
+        if len(pieces) == 1:
+            open_source = lambda: open_piece(audio)
+        else:
+            # The first piece plays while the rest are rendered behind it
+            line = TTSLine(open_piece)
+            line.add(audio)
+            asyncio.create_task(tts.render_line(line, pieces[1:], character, ctx.guild.id, pieces[0]))
+            open_source = lambda: line
 
-        # HIGHEST QUALITY FFmpeg configuration for TTS
-        source = discord.FFmpegPCMAudio(
-            source=str(mp3_path),
-            executable=CFG["FFMPEG_PATH"],
-            before_options='-nostdin',
-            options=f'-b:a 256k -ar 48000 -ac 2 -filter:a "volume={CFG["TTS_VOL"]}"'  # Use TTS_VOL config
-        )
-        
-        # Stop any current playback
-        if vc.is_playing():
-            vc.stop()
-            
-        vc.play(source, after=after_playing)
-        await ctx.send(f"🔊 {character.upper()} » {text}")
-        
+        queue.add(Utterance(key, ctx, f"🔊 {character.upper()} » {text}", open_source))
+
+    except TTSBusy:
+        await ctx.send("⏳ TTS is busy right now, try again in a moment", delete_after=5)
     except Exception as e:
         log.error("TTS error: %s", e)  # Only log, don't send error to chat
-        # Clean up on error
-        try:
-            if 'mp3_path' in locals() and mp3_path.exists():
-                mp3_path.unlink()
-        except:
-            pass
 
 # TTS Commands
 @bot.command(name="tanji")
@@ -1057,40 +2903,176 @@ async def telugum(ctx, *, text):
 # -------------------------------------------------
 
 # Spotify helper functions
-def extract_spotify_info(url):
-    """Extract Spotify playlist or track info"""
-    if not spotify_client:
-        return None
-    
+class AsyncSpotify:
+    """Minimal Spotify Web API client on aiohttp, so lookups never block the event loop"""
+    API = "https://api.spotify.com/v1"
+    TOKEN_URL = "https://accounts.spotify.com/api/token"
+    # Only what spotify_entry needs - keeps 100-item playlist pages small
+    PLAYLIST_FIELDS = "items(track(id,name,duration_ms,artists(name),external_ids(isrc))),next"
+
+    def __init__(self, client_id: str, client_secret: str, token_file: Path):
+        self._auth = aiohttp.BasicAuth(client_id, client_secret)
+        self.token_file = token_file
+        self._session = None
+        self._token = None
+        self._expires_at = 0
+        self._token_lock = asyncio.Lock()
+        self._load_token()
+
+    def _load_token(self):
+        """Reuse the client-credentials token from the last run while it is still valid"""
+        try:
+            if self.token_file.exists():
+                with open(self.token_file, 'r') as f:
+                    data = json.load(f)
+                self._token = data.get('access_token')
+                self._expires_at = data.get('expires_at', 0)
+        except Exception as e:
+            log.warning(f"Failed to load Spotify token: {e}")
+
+    def _save_token(self):
+        try:
+            self.token_file.parent.mkdir(exist_ok=True)
+            with open(self.token_file, 'w') as f:
+                json.dump({'access_token': self._token, 'expires_at': self._expires_at}, f)
+        except Exception as e:
+            log.warning(f"Failed to save Spotify token: {e}")
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        # Created lazily so it binds to the bot's running loop; keep-alive connections are pooled
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=8, ttl_dns_cache=300, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=15),
+            )
+        return self._session
+
+    async def _access_token(self) -> str:
+        async with self._token_lock:
+            if self._token and self._expires_at - 60 > time.time():
+                return self._token
+            async with self._get_session().post(
+                self.TOKEN_URL, data={'grant_type': 'client_credentials'}, auth=self._auth
+            ) as resp:
+                resp.raise_for_status()
+                payload = await resp.json()
+            self._token = payload['access_token']
+            self._expires_at = time.time() + payload.get('expires_in', 3600)
+            self._save_token()
+            return self._token
+
+    async def _get(self, path: str, params=None, retries: int = 4) -> dict:
+        for attempt in range(retries):
+            token = await self._access_token()
+            async with self._get_session().get(
+                f"{self.API}{path}", params=params, headers={'Authorization': f"Bearer {token}"}
+            ) as resp:
+                if resp.status == 429:
+                    delay = min(float(resp.headers.get('Retry-After', 1)), 30)
+                    log.warning(f"Spotify rate limited, retrying in {delay:.0f}s")
+                    await asyncio.sleep(delay)
+                    continue
+                if resp.status == 401:
+                    self._token = None  # Revoked or expired early
+                    continue
+                if resp.status >= 500:
+                    await asyncio.sleep(2 ** attempt)
+                    continue
+                resp.raise_for_status()
+                return await resp.json()
+        raise Exception(f"Spotify request failed after {retries} attempts: {path}")
+
+    async def track(self, track_id: str) -> dict:
+        return await self._get(f"/tracks/{track_id}")
+
+    async def playlist_items(self, playlist_id: str, offset: int = 0) -> dict:
+        return await self._get(f"/playlists/{playlist_id}/tracks", params={
+            'offset': offset, 'limit': 100, 'additional_types': 'track', 'fields': self.PLAYLIST_FIELDS,
+        })
+
+    async def album_tracks(self, album_id: str, offset: int = 0) -> dict:
+        return await self._get(f"/albums/{album_id}/tracks", params={'offset': offset, 'limit': 50})
+
+if os.getenv("SPOTIFY_CLIENT_ID") and os.getenv("SPOTIFY_CLIENT_SECRET"):
+    spotify_client = AsyncSpotify(os.getenv("SPOTIFY_CLIENT_ID"), os.getenv("SPOTIFY_CLIENT_SECRET"), SPOTIFY_TOKEN_FILE)
+    log.info("Spotify client initialized successfully")
+else:
+    spotify_client = None
+    log.warning("Spotify client disabled: SPOTIFY_CLIENT_ID / SPOTIFY_CLIENT_SECRET not set")
+
+SPOTIFY_URL_RE = re.compile(r'spotify\.com/(?:intl-\w+/)?(playlist|track|album)/(\w+)')
+
+def parse_spotify_url(url):
+    """Return (kind, id) for a Spotify playlist, track or album link"""
+    match = SPOTIFY_URL_RE.search(url)
+    return (match.group(1), match.group(2)) if match else (None, None)
+
+def spotify_entry(track, **requester) -> QueueEntry:
+    """Turn a Spotify track object into a queue entry searched on YouTube by name and artist"""
+    artist = track['artists'][0]['name']
+    return QueueEntry(
+        f"{track['name']} {artist}",
+        title=f"{track['name']} - {artist}",
+        duration=(track.get('duration_ms') or 0) // 1000 or None,
+        spotify_id=track.get('id'),
+        isrc=(track.get('external_ids') or {}).get('isrc'),
+        **requester
+    )
+
+async def spotify_pages(kind, item_id):
+    """Yield the tracks of a Spotify link one API page at a time"""
+    if kind == "track":
+        yield [await spotify_client.track(item_id)]
+        return
+    fetch = spotify_client.playlist_items if kind == "playlist" else spotify_client.album_tracks
+    offset = 0
+    while True:
+        page = await fetch(item_id, offset)
+        items = page.get('items') or []
+        tracks = [item.get('track') for item in items] if kind == "playlist" else items
+        # Local files and removed tracks come back empty or without artists
+        yield [t for t in tracks if t and t.get('name') and t.get('artists')]
+        if not page.get('next') or not items:
+            return
+        offset += len(items)
+
+async def expand_spotify(guild_id, pages, requester, after=None, first=()):
+    """Append the remaining pages of a Spotify playlist/album as they arrive, once `after` is done
+
+    `first` is a page already fetched that has to wait its turn behind `after` too.
+    """
+    added = 0
     try:
-        if "playlist" in url:
-            playlist_id = url.split("/playlist/")[1].split("?")[0]
-            results = spotify_client.playlist_tracks(playlist_id)
-            tracks = []
-            for item in results['items']:
-                track = item['track']
-                if track:
-                    query = f"{track['name']} {track['artists'][0]['name']}"
-                    tracks.append(query)
-            return tracks
-        elif "track" in url:
-            track_id = url.split("/track/")[1].split("?")[0]
-            track = spotify_client.track(track_id)
-            query = f"{track['name']} {track['artists'][0]['name']}"
-            return [query]
-        elif "album" in url:
-            album_id = url.split("/album/")[1].split("?")[0]
-            results = spotify_client.album_tracks(album_id)
-            tracks = []
-            for track in results['items']:
-                query = f"{track['name']} {track['artists'][0]['name']}"
-                tracks.append(query)
-            return tracks
+        if after:
+            # Another link is still expanding; queue this one's pages behind it
+            await after
+        if first:
+            get_queue(guild_id).extend(spotify_entry(track, **requester) for track in first)
+            added += len(first)
+            get_player(guild_id).kick()
+        async for tracks in pages:
+            queue = get_queue(guild_id)
+            # Hold further pages back until the queue drains, so 5,000-track lists stay bounded
+            while len(queue) >= CFG["QUEUE_LIMIT"]:
+                await asyncio.sleep(15)
+            queue.extend(spotify_entry(track, **requester) for track in tracks)
+            added += len(tracks)
+            # The queue may have run dry while this page was loading
+            get_player(guild_id).kick()
+        log.info(f"Spotify expansion finished: {added} more tracks queued")
+    except asyncio.CancelledError:
+        raise
     except Exception as e:
         log.error(f"Spotify extraction error: {e}")
-        return None
-    
-    return None
+    finally:
+        if spotify_expanders.get(guild_id) is asyncio.current_task():
+            del spotify_expanders[guild_id]
+
+def cancel_spotify_expansion(guild_id):
+    # Cancelling the newest expander cancels the ones it is waiting on as well
+    task = spotify_expanders.pop(guild_id, None)
+    if task and not task.done():
+        task.cancel()
 
 @bot.command(name='play')
 async def play(ctx, *, query):
@@ -1100,132 +3082,565 @@ async def play(ctx, *, query):
         return
 
     guild_id = ctx.guild.id
-    
-    # Initialize queue for this guild if not exists
-    if guild_id not in music_queues:
-        music_queues[guild_id] = []
+    queue = get_queue(guild_id)
+    requester = {"requester_id": ctx.author.id, "requester_name": ctx.author.display_name}
 
     # Check if it's a Spotify link
     if "spotify.com" in query:
-        tracks = extract_spotify_info(query)
+        kind, item_id = parse_spotify_url(query)
+        if not spotify_client or not kind:
+            log.error("Failed to extract Spotify info")
+            return
+        # Only the first page is awaited; the rest streams in while the first track plays
+        pages = spotify_pages(kind, item_id)
+        try:
+            tracks = await anext(pages)
+        except Exception as e:
+            log.error(f"Spotify extraction error: {e}")
+            return
         if not tracks:
             log.error("Failed to extract Spotify info")
             return
         
-        if len(tracks) == 1:
+        if kind == "track":
             # Single track
             await ctx.send(f'🎵 Adding Spotify track to queue...')
-            music_queues[guild_id].append(tracks[0])
         else:
             # Playlist or album
-            await ctx.send(f'🎵 Adding {len(tracks)} tracks from Spotify to queue...')
-            music_queues[guild_id].extend(tracks)
+            await ctx.send(f'🎵 Adding tracks from Spotify {kind} to queue...')
+            previous = spotify_expanders.get(guild_id)
+            if previous and not previous.done():
+                # The first page goes in after the earlier link's remaining pages, not ahead of them
+                spotify_expanders[guild_id] = asyncio.create_task(
+                    expand_spotify(guild_id, pages, requester, previous, first=tracks))
+                tracks = []
+            else:
+                spotify_expanders[guild_id] = asyncio.create_task(expand_spotify(guild_id, pages, requester))
+        queue.extend(spotify_entry(track, **requester) for track in tracks)
     else:
         # YouTube or search query
-        music_queues[guild_id].append(query)
+        queue.append(QueueEntry(query, **requester))
     
     # If nothing is playing, start playing
     if not vc.is_playing():
-        await play_next(ctx, vc)
-
-async def play_next(ctx_or_guild, vc=None):
-    """Play the next song in queue"""
-    # Handle both ctx and guild objects
-    if hasattr(ctx_or_guild, 'guild'):
-        guild = ctx_or_guild.guild
-        ctx = ctx_or_guild
+        get_player(guild_id).kick(ctx)
     else:
-        guild = ctx_or_guild
-        ctx = None
-    
+        schedule_prefetch(guild_id)
+
+class CircuitBreaker:
+    """Stops hammering a failing dependency: opens after `threshold` straight failures for `cooldown` seconds"""
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+
+    def retry_after(self) -> float:
+        return max(0.0, self.open_until - time.monotonic())
+
+    def success(self):
+        self.failures = 0
+
+    def failure(self):
+        self.failures += 1
+        if self.failures >= self.threshold:
+            self.failures = 0
+            self.open_until = time.monotonic() + self.cooldown
+            log.error(f"{self.threshold} tracks failed in a row; pausing playback starts for {self.cooldown}s")
+
+# Shared by all guilds: when extraction is broken it is broken everywhere
+extract_breaker = CircuitBreaker(CFG["BREAKER_FAILURES"], CFG["BREAKER_COOLDOWN"])
+
+class GuildPlayer:
+    """Long-lived playback task for one guild
+
+    Anything that should move playback forward (!play, a finished track, a replay, a
+    cleared queue) posts a command here, and only this task starts tracks. Concurrent
+    commands and after-callbacks therefore can't race each other into double starts.
+    """
+    IDLE, STARTING, PLAYING, BACKOFF = "idle", "starting", "playing", "backoff"
+
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.state = self.IDLE
+        self.source = None  # the GaplessSource this player last started
+        self.generation = 0  # bumped by reset_music; a start begun before a reset is abandoned
+        self.closed = False
+        self.commands = asyncio.Queue()
+        self.task = asyncio.create_task(self._run())
+
+    def close(self):
+        self.closed = True
+        self.task.cancel()
+
+    def reset(self):
+        """Stop/clear happened: whatever track is being opened right now must not start"""
+        self.generation += 1
+
+    def kick(self, ctx=None):
+        """Start playing if idle; `ctx` gets the now-playing message when no music channel is set"""
+        self.commands.put_nowait(("kick", ctx))
+
+    def _ended(self, source, error):
+        # Runs on the audio thread
+        if error:
+            log.error("Music playback error: %s", error)
+        bot.loop.call_soon_threadsafe(self.commands.put_nowait, ("ended", source))
+
+    async def _run(self):
+        while True:
+            command, arg = await self.commands.get()
+            try:
+                if command == "ended":
+                    # A replaced source's callback is stale; only the live one advances the queue
+                    if arg is not self.source:
+                        continue
+                    self.source = None
+                    self.state = self.IDLE
+                    await self._start_next()
+                elif command == "kick":
+                    guild = bot.get_guild(self.guild_id)
+                    vc = guild.voice_client if guild else None
+                    if self.state == self.PLAYING and vc and (vc.is_playing() or vc.is_paused()):
+                        continue
+                    if self.state != self.BACKOFF or not extract_breaker.retry_after():
+                        await self._start_next(arg)
+            except asyncio.CancelledError:
+                if self.closed:
+                    raise
+                # A shared resolve cancelled under us (e.g. a dropped prefetch); not our cancellation
+                log.error("Player start cancelled")
+                self.state = self.IDLE
+            except Exception as e:
+                log.error("Player error: %s", e)
+                self.state = self.IDLE
+
+    async def _open(self, entry):
+        """Resolve and open a track, retrying transient failures with backoff"""
+        for attempt in range(CFG["PLAY_RETRIES"] + 1):
+            try:
+                data = await resolve_entry(entry, self.guild_id)
+                return open_track(data, entry, self.guild_id)
+            except Exception as e:
+                if attempt == CFG["PLAY_RETRIES"]:
+                    raise
+                delay = min(2 ** attempt, 30) + random.random()
+                log.error(f"Couldn't open {entry.display[:50]} ({e}); retrying in {delay:.1f}s")
+                resolve_cache.invalidate(entry.lookup_query)
+                await asyncio.sleep(delay)
+
+    async def _start_next(self, ctx=None):
+        guild = bot.get_guild(self.guild_id)
+        queue = get_queue(self.guild_id)
+        while True:
+            vc = guild.voice_client if guild else None
+            if self.guild_id in parked_guilds:
+                # Parked (or being parked); unpark kicks again once someone is back
+                self.state = self.IDLE
+                return
+            if not vc:
+                log.info("No voice client available")
+                discard_preload(self.guild_id)
+                self.state = self.IDLE
+                return
+            if vc.is_playing() or vc.is_paused():
+                # Something else (TTS) has the voice client; the queue waits for the next kick
+                self.state = self.IDLE
+                return
+            wait = extract_breaker.retry_after()
+            if wait:
+                self.state = self.BACKOFF
+                bot.loop.call_later(wait, self.kick)
+                return
+
+            generation = self.generation
+            # A skip lands here with the next track usually already opened and buffered
+            preloaded = await take_preload(self.guild_id)
+            if preloaded:
+                player, entry = preloaded
+            elif not queue:
+                log.info("Queue is empty")
+                self.state = self.IDLE
+                return
+            else:
+                entry = queue.popleft()
+                self.state = self.STARTING
+                try:
+                    player = await self._open(entry)
+                except Exception as e:
+                    if generation != self.generation:
+                        self.state = self.IDLE
+                        return
+                    log.error("Play command error: %s", e)
+                    extract_breaker.failure()
+                    continue
+            if generation != self.generation:
+                # Stopped or cleared while this track was opening; drop it
+                player.cleanup()
+                self.state = self.IDLE
+                return
+            extract_breaker.success()
+
+            vc = guild.voice_client
+            if not vc or vc.is_playing() or vc.is_paused():
+                # Lost the voice client (or it got busy) while resolving; keep the track for later
+                player.cleanup()
+                queue.appendleft(entry)
+                continue
+            source = GaplessSource(self.guild_id, player, entry)
+            # Tracks may switch between Opus passthrough and PCM without restarting the player
+            ensure_encoder(vc)
+            vc.play(source, after=lambda error: self._ended(source, error))
+            self.source = source
+            self.state = self.PLAYING
+            await now_playing(guild, entry, player, ctx)
+            return
+
+def open_track(data, entry, guild_id):
+    """Playable source for a resolved queue entry at the guild's volume"""
+    return YTDLSource.create(
+        data, volume=guild_volumes.get(guild_id, CFG["DEF_VOL"]), seek=entry.start, pcm=CFG["CROSSFADE_SECONDS"] > 0
+    )
+
+def get_player(guild_id) -> GuildPlayer:
+    player = guild_players.get(guild_id)
+    if player is None or player.task.done():
+        if player is not None and not player.closed:
+            log.error(f"Player task for guild {guild_id} died; starting a new one")
+        player = guild_players[guild_id] = GuildPlayer(guild_id)
+    return player
+
+async def now_playing(guild, entry, player, ctx=None):
+    """Number, record and announce a track that just started"""
     guild_id = guild.id
     
-    if not vc:
-        vc = guild.voice_client
+    # Track numbering and history
+    idx = play_indices.get(guild_id, 0) + 1
+    play_indices[guild_id] = idx
+    
+    requester_id = entry.requester_id
+    requester_name = entry.requester_name
+    
+    # Track user song
+    play_count = track_user_song(requester_id, requester_name, player.title)
+    
+    current_track[guild_id] = {
+        "index": idx, 
+        "query": entry.query, 
+        "title": player.title,
+        "url": entry.query,
+        "thumbnail": player.data.get('thumbnail'),
+        "requester_id": requester_id,
+        "requester_name": requester_name,
+        "play_count": play_count,
+        # Resolved identity, so a replay fetches this exact video instead of searching again
+        "video_id": player.data.get('id'),
+        "duration": player.data.get('duration'),
+    }
+    get_history(guild_id).append(current_track[guild_id])
+    audio_cache.touch(player.data.get('id'))
+    schedule_prefetch(guild_id)
     
-    if not vc:
-        log.info("No voice client available")
-        return
+    # Update control panel if music channel is set
+    await update_control_panel(guild, current_track[guild_id])
     
-    if guild_id not in music_queues or len(music_queues[guild_id]) == 0:
-        log.info("Queue is empty")
+    # Only send text message if music channel is NOT set (control panel shows everything)
+    if guild_id not in music_channels:
+        # Send message in appropriate channel
+        remaining = len(get_queue(guild_id))
+        msg = f'🎵 Now playing: [#{idx}] **{player.title}**'
+        if remaining > 0:
+            msg += f' ({remaining} in queue)'
+        
+        if ctx:
+            await ctx.send(msg)
+
+async def preload_next(guild_id):
+    """Resolve, open and buffer the next queued track; returns (source, entry) or None"""
+    queue = get_queue(guild_id)
+    if not queue:
+        return None
+    entry = queue.popleft()
+    source = None
+    try:
+        data = await resolve_entry(entry, guild_id)
+        source = open_track(data, entry, guild_id)
+        frames = int(CFG["GAPLESS_BUFFER"] / FRAME_SECONDS)
+        await asyncio.get_running_loop().run_in_executor(None, source.prebuffer, frames)
+        return source, entry
+    except asyncio.CancelledError:
+        if source:
+            source.cleanup()
+        raise
+    except Exception as e:
+        log.error(f"Preload failed for {entry.display[:50]}: {e}")
+        if source:
+            source.cleanup()
+        # Back to the front: the player retries it with backoff when the current track ends
+        queue.appendleft(entry)
+        return None
+
+def on_track_preroll(gapless):
+    """Audio thread says the current track is nearly over: open the next one now"""
+    guild_id = gapless.guild_id
+    if gapless.finished or guild_id in preloads:
         return
-    
-    query = music_queues[guild_id].pop(0)
-    
+    task = preloads[guild_id] = asyncio.create_task(preload_next(guild_id))
+    def attach(t):
+        if not t.cancelled() and t.result() and preloads.get(guild_id) is t:
+            gapless.set_next(*t.result())
+    task.add_done_callback(attach)
+
+def on_track_advance(gapless, player, entry):
+    """Audio thread switched to the preloaded track; do the bookkeeping a fresh start would have"""
+    guild_id = gapless.guild_id
+    task = preloads.get(guild_id)
+    if task and task.done() and not task.cancelled() and task.result() and task.result()[0] is player:
+        del preloads[guild_id]
+    guild = bot.get_guild(guild_id)
+    if not guild:
+        return
+    volume = guild_volumes.get(guild_id, CFG["DEF_VOL"])
+    if player.is_opus() and volume != 1.0:
+        set_music_volume(guild, volume)
+    asyncio.create_task(now_playing(guild, entry, player))
+
+def on_stream_lost(gapless, track):
+    """Audio thread saw a stream end early; recover it off the audio thread"""
+    asyncio.create_task(recover_stream(gapless, track))
+
+async def recover_stream(gapless, track):
+    """Re-resolve a track whose stream URL died and resume it where it stopped"""
+    guild_id = gapless.guild_id
+    entry = gapless.entry
+    position = track.position
+    log.info(f"Stream for {(track.title or entry.display)[:50]} died at {position:.0f}s; re-resolving")
+    # The cached URL is the one that just failed
+    resolve_cache.invalidate(entry.lookup_query)
     try:
-        player = await YTDLSource.from_url(query, loop=bot.loop, stream=True)
-        
-        def after_playing(error):
-            if error:
-                log.error("Music playback error: %s", error)
-            # Play next song in queue
-            asyncio.run_coroutine_threadsafe(play_next(guild, vc), bot.loop)
-        
-        # Track numbering and history
-        idx = play_indices.get(guild_id, 0) + 1
-        play_indices[guild_id] = idx
-        
-        # Get requester ID if available
-        requester_id = 0
-        requester_name = "Unknown"
-        if ctx and hasattr(ctx, 'author'):
-            requester_id = ctx.author.id
-            requester_name = ctx.author.display_name
-        
-        # Track user song
-        play_count = track_user_song(requester_id, requester_name, player.title)
-        
-        current_track[guild_id] = {
-            "index": idx, 
-            "query": query, 
-            "title": player.title,
-            "url": query,
-            "thumbnail": player.data.get('thumbnail'),
-            "requester_id": requester_id,
-            "play_count": play_count
-        }
-        played_history.setdefault(guild_id, []).append(current_track[guild_id])
-        
-        vc.play(player, after=after_playing)
-        
-        # Update control panel if music channel is set
-        await update_control_panel(guild, current_track[guild_id])
-        
-        # Only send text message if music channel is NOT set (control panel shows everything)
-        if guild_id not in music_channels:
-            # Send message in appropriate channel
-            remaining = len(music_queues[guild_id])
-            msg = f'🎵 Now playing: [#{idx}] **{player.title}**'
-            if remaining > 0:
-                msg += f' ({remaining} in queue)'
-            
-            if ctx:
-                await ctx.send(msg)
-            
+        data = await resolve_entry(entry, guild_id)
+        fresh = YTDLSource.create(
+            data, volume=guild_volumes.get(guild_id, CFG["DEF_VOL"]), seek=position, pcm=CFG["CROSSFADE_SECONDS"] > 0
+        )
+    except asyncio.CancelledError:
+        gapless.give_up(track)
+        raise
     except Exception as e:
-        log.error("Play command error: %s", e)
-        # Try next song if this one fails
-        await play_next(guild, vc)
+        log.error(f"Stream recovery failed for {entry.display[:50]}: {e}")
+        gapless.give_up(track)
+        return
+    guild = bot.get_guild(guild_id)
+    if guild and guild.voice_client and not fresh.is_opus():
+        ensure_encoder(guild.voice_client)
+    if not gapless.resume(track, fresh):
+        fresh.cleanup()
+
+async def take_preload(guild_id):
+    """Hand the preloaded next track to the player, waiting if it is still opening"""
+    task = preloads.pop(guild_id, None)
+    if task is None:
+        return None
+    try:
+        return await task
+    except asyncio.CancelledError:
+        return None
 
-async def check_and_disconnect(voice_client, guild_id):
-    """Check if should disconnect after playback"""
-    await asyncio.sleep(2)  # Wait a bit
-    
-    # Check if voice client still exists and is not playing
+def detach_preload(guild_id, source) -> bool:
+    """Unhook a preloaded track from the live GaplessSource; False if the switch to it already happened"""
     guild = bot.get_guild(guild_id)
-    if not guild or not guild.voice_client:
+    vc = guild.voice_client if guild else None
+    if vc and isinstance(vc.source, GaplessSource):
+        return vc.source.drop_next(source)
+    return True
+
+def discard_preload(guild_id):
+    task = preloads.pop(guild_id, None)
+    if task is None:
         return
-        
+    if not task.done():
+        task.cancel()
+    elif not task.cancelled() and task.result():
+        source = task.result()[0]
+        if detach_preload(guild_id, source):
+            source.cleanup()
+
+async def replay_track(guild, vc, info):
+    """Play a track from history next, by its resolved video, without skipping anything queued"""
+    guild_id = guild.id
+    queue = get_queue(guild_id)
+    # A preloaded track was already taken off the queue; give it its place back behind the replay
+    await requeue_preload(guild_id)
+    queue.appendleft(QueueEntry(
+        info['query'],
+        video_id=info.get('video_id'),
+        title=info.get('title'),
+        duration=info.get('duration'),
+        requester_id=info.get('requester_id', 0),
+        requester_name=info.get('requester_name', "Unknown"),
+    ))
+    if vc.is_playing() or vc.is_paused():
+        # The player's after-callback moves on to the replay at the front
+        vc.stop()
+    else:
+        get_player(guild_id).kick()
+
+async def requeue_preload(guild_id):
+    """Put a preloaded, not yet playing track back at the front of the queue"""
+    preloaded = await take_preload(guild_id)
+    if preloaded:
+        source, entry = preloaded
+        if detach_preload(guild_id, source):
+            source.cleanup()
+            get_queue(guild_id).appendleft(entry)
+
+def has_listeners(channel) -> bool:
+    return any(not member.bot for member in channel.members)
+
+def update_idle(guild):
+    """Start the park timer when the bot's channel has no humans left; cancel it when one is back"""
     vc = guild.voice_client
-    
-    if vc and not vc.is_playing() and not vc.is_paused():
-        await asyncio.sleep(60)  # Wait 1 minute before disconnecting
-        if vc and not vc.is_playing() and not vc.is_paused():
-            try:
-                await vc.disconnect()
-            except Exception as e:
-                log.error("Disconnect error: %s", e)
+    timer = idle_timers.get(guild.id)
+    if vc and vc.channel and not has_listeners(vc.channel):
+        if not timer:
+            idle_timers[guild.id] = asyncio.create_task(park_after(guild.id, CFG["IDLE_PARK_SECONDS"]))
+    elif timer:
+        timer.cancel()
+        del idle_timers[guild.id]
+
+async def park_after(guild_id, delay):
+    try:
+        await asyncio.sleep(delay)
+        idle_timers.pop(guild_id, None)
+        guild = bot.get_guild(guild_id)
+        vc = guild.voice_client if guild else None
+        if vc and vc.channel and not has_listeners(vc.channel):
+            await park(guild)
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        log.error(f"Failed to park voice client: {e}")
+
+async def park(guild):
+    """Disconnect from an empty channel, keeping the queue (and the playing track's position) to resume"""
+    guild_id = guild.id
+    vc = guild.voice_client
+    parked_guilds[guild_id] = vc.channel.id
+    queue = get_queue(guild_id)
+    await requeue_preload(guild_id)
+    source = vc.source
+    if isinstance(source, GaplessSource) and not source.finished:
+        entry = source.entry
+        entry.start = source.current.position
+        queue.appendleft(entry)
+    cancel_prefetch(guild_id)
+    # Nobody is left to hear queued lines; a line already being spoken finishes on its own
+    tts = tts_queues.pop(guild_id, None)
+    if tts:
+        tts.clear()
+    # Disconnecting stops the player, which kills FFmpeg and drops the stream buffers
+    await vc.disconnect(force=True)
+    player = guild_players.pop(guild_id, None)
+    if player:
+        player.close()
+    current_track.pop(guild_id, None)
+    voice_connect_stats.pop(guild_id, None)
+    # Recent plays go to the spill file so their numbers stay replayable; without one they are let go.
+    # Play numbering and the volume setting are a single value each and are kept.
+    history = played_history.pop(guild_id, None)
+    if history and history.spill:
+        await asyncio.get_running_loop().run_in_executor(None, history.flush)
+    if not queue:
+        music_queues.pop(guild_id, None)
+    log.info(f"Parked voice in guild {guild_id} ({len(queue)} tracks kept)")
+
+async def unpark(guild, channel):
+    """Someone came back to a parked channel: rejoin and carry on with the queue"""
+    guild_id = guild.id
+    started = time.monotonic()
+    try:
+        vc = await channel.connect(timeout=CFG["VOICE_CONNECT_TIMEOUT"], reconnect=True, cls=FixedVoiceClient, self_deaf=False)
+        if not await wait_voice_ready(vc, CFG["VOICE_CONNECT_TIMEOUT"]):
+            raise Exception("Connection established but not connected")
+    except Exception as e:
+        # Stay parked; the next join tries again
+        log.error(f"Failed to rejoin parked channel: {e}")
+        return
+    record_voice_latency(guild_id, "unpark", started, 1)
+    parked_guilds.pop(guild_id, None)
+    if get_queue(guild_id):
+        get_player(guild_id).kick()
+
+def reset_music(guild_id):
+    """Drop everything queued, prefetched or preloaded for a guild (stop / leave / clear)"""
+    if guild_id in music_queues:
+        music_queues[guild_id].clear()
+    cancel_prefetch(guild_id)
+    cancel_spotify_expansion(guild_id)
+    discard_preload(guild_id)
+    if guild_id in guild_players:
+        guild_players[guild_id].reset()
+
+async def resolve_entry(entry, guild_id, lane=LANE_INTERACTIVE):
+    """Resolve a queue entry, filling in its metadata and remembering Spotify matches"""
+    query = entry.lookup_query
+    try:
+        data = await YTDLSource.resolve(query, guild_id=guild_id, lane=lane)
+    except Exception:
+        if query == entry.query or not entry.spotify_id:
+            raise
+        # A remembered match went unavailable; forget it and search again
+        spotify_matches.forget(entry.spotify_id, entry.isrc)
+        entry.video_id = None
+        data = await YTDLSource.resolve(entry.query, guild_id=guild_id, lane=lane)
+    entry.update_from(data)
+    if entry.spotify_id and data.get('id'):
+        spotify_matches.record(data['id'], entry.spotify_id, entry.isrc)
+    return data
+
+def is_resolved(query) -> bool:
+    """True when resolving `query` needs no extraction: a fresh resolve or a cached track"""
+    if resolve_cache.contains(query):
+        return True
+    key = resolve_cache.normalize(query)
+    return key.startswith("yt:") and audio_cache.lookup(key[3:]) is not None
+
+async def prefetch_upcoming(guild_id):
+    """Resolve the next few queued tracks so the handoff after a song is a cache hit"""
+    done = []  # entries already resolved by this run
+    while True:
+        upcoming = get_queue(guild_id).peek(CFG["PREFETCH_AHEAD"])
+        pending = [(pos, e) for pos, e in enumerate(upcoming)
+                   if not any(e is d for d in done) and not is_resolved(e.lookup_query)]
+        if not pending:
+            return
+        pos, entry = pending[0]
+        query = entry.query
+        # Only the very next track gets the prefetch lane; the rest of the look-ahead is bulk work
+        lane = LANE_PREFETCH if pos == 0 else LANE_BULK
+        try:
+            await resolve_entry(entry, guild_id, lane)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            log.warning(f"Prefetch failed for {query[:50]}: {e}")
+            return
+        # Step past it even if its result isn't in the resolve cache (e.g. served from disk)
+        done.append(entry)
+
+def schedule_prefetch(guild_id):
+    """Start the look-ahead resolver for a guild unless it is already running"""
+    task = prefetch_tasks.get(guild_id)
+    if task and not task.done():
+        return
+    prefetch_tasks[guild_id] = bot.loop.create_task(prefetch_upcoming(guild_id))
+
+def cancel_prefetch(guild_id):
+    """Stop look-ahead work for a guild, e.g. when its queue is cleared or reordered"""
+    task = prefetch_tasks.pop(guild_id, None)
+    if task and not task.done():
+        task.cancel()
+    extractor.cancel_pending(guild_id, LANE_PREFETCH)
+    extractor.cancel_pending(guild_id, LANE_BULK)
 
 @bot.command(name='stop')
 async def stop(ctx):
@@ -1233,8 +3648,7 @@ async def stop(ctx):
     if ctx.voice_client:
         # Clear the queue
         guild_id = ctx.guild.id
-        if guild_id in music_queues:
-            music_queues[guild_id].clear()
+        reset_music(guild_id)
         
         if ctx.voice_client.is_playing():
             ctx.voice_client.stop()
@@ -1262,7 +3676,7 @@ async def queue(ctx):
         await ctx.send('🎵 Queue is empty')
         return
     
-    queue_list = music_queues[guild_id][:10]  # Show first 10
+    queue_list = music_queues[guild_id].peek(10)  # Show first 10
     total = len(music_queues[guild_id])
     
     embed = discord.Embed(
@@ -1271,14 +3685,44 @@ async def queue(ctx):
         color=0x1DB954  # Spotify green
     )
     
-    for i, song in enumerate(queue_list, 1):
-        embed.add_field(name=f"{i}.", value=song[:50], inline=False)
+    for i, entry in enumerate(queue_list, 1):
+        embed.add_field(name=f"{i}.", value=entry.display[:50], inline=False)
     
     if total > 10:
         embed.set_footer(text=f"... and {total - 10} more songs")
     
     await ctx.send(embed=embed)
 
+@bot.command(name='remove', aliases=['rm'])
+async def remove(ctx, position: int):
+    """Remove a song from the queue by its position"""
+    queue = get_queue(ctx.guild.id)
+    if not 1 <= position <= len(queue):
+        await ctx.send(f'❌ No song at position {position}')
+        return
+    entry = queue.remove(position - 1)
+    if position <= CFG["PREFETCH_AHEAD"]:
+        schedule_prefetch(ctx.guild.id)
+    await ctx.send(f'🗑️ Removed **{entry.display[:50]}**')
+
+@bot.command(name='move', aliases=['mv'])
+async def move(ctx, src: int, dst: int):
+    """Move a queued song to another position"""
+    queue = get_queue(ctx.guild.id)
+    if not (1 <= src <= len(queue) and 1 <= dst <= len(queue)):
+        await ctx.send('❌ Invalid queue position')
+        return
+    entry = queue.move(src - 1, dst - 1)
+    if min(src, dst) <= CFG["PREFETCH_AHEAD"]:
+        schedule_prefetch(ctx.guild.id)
+    await ctx.send(f'↕️ Moved **{entry.display[:50]}** to position {dst}')
+
+@bot.command(name='dedupe')
+async def dedupe(ctx):
+    """Remove duplicate songs from the queue"""
+    removed = get_queue(ctx.guild.id).dedupe()
+    await ctx.send(f'🧹 Removed {removed} duplicate songs' if removed else '✅ No duplicates in queue')
+
 @bot.command(name='replay', aliases=['rp'])
 async def replay(ctx, number: typing.Optional[int] = None):
     """Replay current song or a previously played song by number"""
@@ -1287,33 +3731,19 @@ async def replay(ctx, number: typing.Optional[int] = None):
     if not vc:
         return
     try:
-        # Stop current playback if needed
-        if ctx.voice_client and (ctx.voice_client.is_playing() or ctx.voice_client.is_paused()):
-            ctx.voice_client.stop()
         # Determine target track
         if number is None:
             info = current_track.get(guild_id)
             if not info:
                 await ctx.send('❌ No track to replay')
                 return
-            query = info['query']
-            idx = info['index']
         else:
-            history = played_history.get(guild_id, [])
-            match = next((t for t in history if t['index'] == number), None)
-            if not match:
+            info = await get_history(guild_id).lookup(number)
+            if not info:
                 await ctx.send(f'❌ No track numbered #{number} found')
                 return
-            query = match['query']
-            idx = number
-        # Play immediately
-        player = await YTDLSource.from_url(query, loop=bot.loop, stream=True)
-        def after_playing(error):
-            if error:
-                log.error("Music playback error: %s", error)
-            asyncio.run_coroutine_threadsafe(play_next(ctx, vc), bot.loop)
-        vc.play(player, after=after_playing)
-        await ctx.send(f'🔁 Replaying [#{idx}] **{player.title}**')
+        await replay_track(ctx.guild, vc, info)
+        await ctx.send(f"🔁 Replaying [#{info['index']}] **{info['title']}**")
     except Exception as e:
         log.error(f"Replay error: {e}")
 
@@ -1428,7 +3858,7 @@ async def help_command(ctx):
     
     embed.add_field(
         name="🎵 Music Commands", 
-        value="• `!play <song/url>`\n  → YouTube, Spotify tracks/playlists\n• `!skip` - skip to next song\n• `!queue` or `!q` - show queue\n• `!stop` - stop & clear queue\n• `!pause` / `!resume`\n• `!leave` or `!l`\n• `/clearqueue` - restart from song #1",
+        value="• `!play <song/url>`\n  → YouTube, Spotify tracks/playlists\n• `!skip` - skip to next song\n• `!queue` or `!q` - show queue\n• `!remove <n>` / `!move <from> <to>` / `!dedupe`\n• `!stop` - stop & clear queue\n• `!pause` / `!resume`\n• `!leave` or `!l`\n• `/clearqueue` - restart from song #1",
         inline=False
     )
     
@@ -1489,10 +3919,10 @@ async def clearqueue(interaction: discord.Interaction):
     
     try:
         # Get first song before clearing
-        first_song = music_queues[guild_id][0] if music_queues[guild_id] else None
+        first_song = music_queues[guild_id].popleft() if music_queues[guild_id] else None
         
         # Clear the queue
-        music_queues[guild_id].clear()
+        reset_music(guild_id)
         queue_positions[guild_id] = 0
         
         # Stop current playback if any
@@ -1507,7 +3937,7 @@ async def clearqueue(interaction: discord.Interaction):
             
             # Play the first song
             if vc and vc.is_connected():
-                await play_next(interaction.guild)
+                get_player(guild_id).kick()
             else:
                 await interaction.followup.send("⚠️ Bot not in voice channel. Use `!play` to start.", ephemeral=True)
         else:
@@ -2285,25 +4715,25 @@ async def confess(ctx, member: discord.Member):
 @bot.command(name='moan')
 async def moan(ctx):
     """Play anime moan sound effect"""
-    await play_tts(ctx, "girl", text="Ahhhh... *moans*")
+    await play_clip(ctx, "moan")
 
 @bot.command(name='scream')
 async def scream(ctx):
     """Play anime scream sound effect"""
-    await play_tts(ctx, "girl", text="KYAAAAAAAAA! AHHHHHHHH!")
+    await play_clip(ctx, "scream")
 
 @bot.command(name='laughaudio')
 async def laughaudio(ctx):
     """Play anime laugh sound effect"""
-    await play_tts(ctx, "girl", text="Hahahahaha! Hehehehe! Fufufufu~")
+    await play_clip(ctx, "laughaudio")
 
 @bot.command(name='bassboost')
 async def bassboost(ctx):
     """Bass boost the current audio"""
     if ctx.voice_client and ctx.voice_client.is_playing():
         # Increase volume for bass boost effect
-        if hasattr(ctx.voice_client.source, 'volume'):
-            ctx.voice_client.source.volume = min(2.0, ctx.voice_client.source.volume + 0.5)
+        new_vol = min(2.0, guild_volumes.get(ctx.guild.id, CFG["DEF_VOL"]) + 0.5)
+        if set_music_volume(ctx.guild, new_vol):
             await ctx.send("🔊💥 BASS BOOSTED! 🔊💥")
     else:
         await ctx.send("❌ No audio playing to bass boost!")
@@ -2311,7 +4741,7 @@ async def bassboost(ctx):
 @bot.command(name='nekoaudio')
 async def nekoaudio(ctx):
     """Play neko/cat girl sound"""
-    await play_tts(ctx, "child", text="Nya nya~ Meow meow~ Nyan nyan~")
+    await play_clip(ctx, "nekoaudio")
 
 @bot.command(name='animegirl')
 async def animegirl(ctx):
@@ -3016,6 +5446,8 @@ if __name__ == "__main__":
     async def cleanup():
         """Cleanup function to properly close connections"""
         log.info("Cleaning up...")
+        spotify_matches.save()
+        audio_cache.save()
         for vc in bot.voice_clients:
             try:
                 await vc.disconnect(force=True)